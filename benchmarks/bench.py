@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# Benchmarks for the hot paths, results are written as json and can be compared with
+# a previous run to catch regressions, i.e.
+#   python benchmarks/bench.py --output baseline.json
+#   python benchmarks/bench.py --baseline baseline.json
+# exits non-zero if anything is slower than the baseline by more than the tolerance.
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import struct
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tlwpy.liblorawan
+from tlwpy import lorawan
+from tlwpy.gatewaysimulator import render_rxpk
+from tlwpy.ingest import Message
+from tlwpy.loopback import LoopbackBroker, TlwbeStandIn
+from tlwpy.metrics import Histogram
+from tlwpy.pktfwdbr import decode_rx
+from tlwpy.radio import EU868
+from tlwpy.tlwbe import Tlwbe
+
+KEY = bytes(range(16))
+DEVADDR = 0x26011234
+PAYLOAD = bytes(range(16))
+
+
+def measure(fn, iterations: int, repeat: int = 5):
+    # best of a few runs, anything slower than that is noise from the rest of the machine
+    best = min(timeit.repeat(fn, number=iterations, repeat=repeat))
+    return {'ops_per_sec': iterations / best,
+            'ns_per_op': (best / iterations) * 1e9}
+
+
+def codec_benchmarks(iterations: int):
+    uplink = tlwpy.liblorawan.build_data(int(lorawan.PacketType.UNCONFIRMED_UP), DEVADDR, 1, 1, PAYLOAD, KEY, KEY)
+    joinreq = tlwpy.liblorawan.build_joinreq(KEY, bytes(8), bytes(range(8)), 1)
+    # mhdr, appnonce, netid, devaddr, dlsettings, rxdelay, mic
+    joinaccept = bytes([0x20]) + bytes(6) + struct.pack('<IBB', DEVADDR, 0, 1) + bytes(4)
+
+    def parse_uplink():
+        frame = lorawan.Uplink(uplink)
+        return frame.port, frame.frmpayload
+
+    return {'parse_data': measure(parse_uplink, iterations),
+            'parse_joinreq': measure(lambda: lorawan.JoinReq(joinreq), iterations),
+            'parse_joinaccept': measure(lambda: lorawan.JoinAccept(joinaccept), iterations)}
+
+
+def crypto_benchmarks(iterations: int):
+    uplink = tlwpy.liblorawan.build_data(int(lorawan.PacketType.UNCONFIRMED_UP), DEVADDR, 1, 1, PAYLOAD, KEY, KEY)
+    joinaccept = bytes([0x20]) + bytes(16)
+    build_type = int(lorawan.PacketType.UNCONFIRMED_UP)
+    return {'build_data': measure(lambda: tlwpy.liblorawan.build_data(build_type, DEVADDR, 1, 1, PAYLOAD, KEY, KEY),
+                                  iterations),
+            'calculate_mic': measure(lambda: tlwpy.liblorawan.calculate_mic(KEY, uplink[:-4]), iterations),
+            'decrypt_joinack': measure(lambda: tlwpy.liblorawan.decrypt_joinack(KEY, joinaccept), iterations)}
+
+
+def pktfwdbr_benchmarks(iterations: int):
+    uplink = tlwpy.liblorawan.build_data(int(lorawan.PacketType.UNCONFIRMED_UP), DEVADDR, 1, 1, PAYLOAD, KEY, KEY)
+    rxpk = {'tmst': 3889331076, 'chan': 1, 'rfch': 0, 'freq': 923.4, 'stat': 1, 'modu': 'LORA',
+            'datr': 'SF10BW125', 'codr': '4/5', 'lsnr': 12.0, 'rssi': -48, 'size': len(uplink),
+            'data': base64.b64encode(uplink).decode('ascii')}
+    msg = Message('pktfwdbr/gw/rx/unconfirmed', json.dumps(rxpk).encode('utf-8'))
+    return {'pktfwdbr_decode_rx': measure(lambda: decode_rx(msg), iterations)}
+
+
+def gatewaysimulator_benchmarks(iterations: int):
+    uplink = tlwpy.liblorawan.build_data(int(lorawan.PacketType.UNCONFIRMED_UP), DEVADDR, 1, 1, PAYLOAD, KEY, KEY)
+    channel, datr = EU868.pick()
+    return {'gatewaysimulator_render_rxpk': measure(lambda: render_rxpk(uplink, channel, datr, 3889331076, 12.0, -48),
+                                                    iterations)}
+
+
+async def tlwbe_benchmarks(iterations: int, mqtt_host: str = None, mqtt_port: int = None):
+    if mqtt_host is None:
+        broker = LoopbackBroker()
+        TlwbeStandIn(broker.client('tlwbe_standin'))
+        tlwbe = broker.create(Tlwbe)
+        transport = 'loopback'
+    else:
+        import paho.mqtt.client as mqtt
+        client = mqtt.Client()
+        client.connect(mqtt_host, mqtt_port if mqtt_port is not None else 1883)
+        client.loop_start()
+        TlwbeStandIn(client)
+        tlwbe = Tlwbe(mqtt_host, port=mqtt_port)
+        transport = 'mqtt'
+    await tlwbe.wait_for_connection()
+    # let the stand-in's subscriptions land before timing anything
+    await tlwbe.list_devs()
+
+    loop = asyncio.get_running_loop()
+    latencies = Histogram(window=None)
+    start = loop.time()
+    for _ in range(iterations):
+        request_start = loop.time()
+        await tlwbe.list_devs()
+        latencies.observe(loop.time() - request_start)
+    elapsed = loop.time() - start
+    serial = {'ops_per_sec': iterations / elapsed,
+              'p50': latencies.percentile(50),
+              'p99': latencies.percentile(99)}
+
+    devs = [('bench_%d' % i, '0000000000000000', '%016x' % i, KEY.hex()) for i in range(iterations)]
+    start = loop.time()
+    result = await tlwbe.add_devs(devs)
+    elapsed = loop.time() - start
+    assert result.ok, '%d adds failed' % len(result.failures)
+    pipelined = {'ops_per_sec': iterations / elapsed}
+    await tlwbe.delete_devs([dev[2] for dev in devs])
+
+    return {'tlwbe_round_trip_%s' % transport: serial,
+            'tlwbe_pipelined_%s' % transport: pipelined}
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = (result['ops_per_sec'] / base['ops_per_sec']) - 1
+        result['change'] = change
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tlwpy benchmarks')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--round-trips', type=int, default=1000)
+    parser.add_argument('--output', type=str, help='write results here instead of stdout')
+    parser.add_argument('--baseline', type=str, help='results from a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='how much slower than the baseline something can be before it is a regression')
+    parser.add_argument('--mqtt-host', type=str, help='measure tlwbe round trips through this broker')
+    parser.add_argument('--mqtt-port', type=int)
+    args = parser.parse_args()
+
+    results = {}
+    results.update(codec_benchmarks(args.iterations))
+    results.update(crypto_benchmarks(args.iterations))
+    results.update(pktfwdbr_benchmarks(args.iterations))
+    results.update(gatewaysimulator_benchmarks(args.iterations))
+    results.update(asyncio.run(tlwbe_benchmarks(args.round_trips, args.mqtt_host, args.mqtt_port)))
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results,
+              'regressions': regressions}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    for name in regressions:
+        print('%s regressed by %.1f%%' % (name, -results[name]['change'] * 100), file=sys.stderr)
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,3 +24,10 @@ def mosquitto_process(mosquitto_path):
     yield process
     process.terminate()
     process.wait()
+
+
+@pytest.fixture
+def loopback_broker():
+    # for tests that don't need a real broker, clients come from loopback_broker.create(cls, ...)
+    from tlwpy.loopback import LoopbackBroker
+    return LoopbackBroker()
@@ -0,0 +1,65 @@
+import pytest
+import tlwpy.devnonce
+from tlwpy.devnonce import DevNonceStore
+
+
+def test_monotonic():
+    store = DevNonceStore()
+    assert [store.next('0000000000000001') for _ in range(3)] == [0, 1, 2]
+    assert store.next('0000000000000002') == 0
+
+
+def test_random_doesnt_repeat():
+    store = DevNonceStore(random_nonces=True)
+    nonces = [store.next('0000000000000001') for _ in range(tlwpy.devnonce.DEVNONCE_MAX + 1)]
+    assert len(set(nonces)) == len(nonces)
+
+
+def test_persistence(tmp_path):
+    path = str(tmp_path / 'nonces.json')
+    store = DevNonceStore(path)
+    store.next('0000000000000001')
+    store.next('0000000000000001')
+    store = DevNonceStore(path)
+    assert store.next('0000000000000001') == 2
+
+
+def test_exhausted():
+    store = DevNonceStore()
+    for _ in range(tlwpy.devnonce.DEVNONCE_MAX + 1):
+        store.next('0000000000000001')
+    with pytest.raises(tlwpy.devnonce.NoncesExhaustedException):
+        store.next('0000000000000001')
+
+
+def test_reserve(tmp_path):
+    path = str(tmp_path / 'nonces.json')
+    store = DevNonceStore(path, reserve=8)
+    assert [store.next('0000000000000001') for _ in range(3)] == [0, 1, 2]
+    # only the first nonce had to be written
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+    # what was reserved might have been used so a restart skips past it
+    store = DevNonceStore(path, reserve=8)
+    assert store.next('0000000000000001') == 8
+
+
+def test_random_persistence(tmp_path):
+    path = str(tmp_path / 'nonces.json')
+    store = DevNonceStore(path, random_nonces=True)
+    nonces = [store.next('0000000000000001') for _ in range(3)]
+    store.close()
+    store = DevNonceStore(path, random_nonces=True)
+    nonces += [store.next('0000000000000001') for _ in range(3)]
+    assert len(set(nonces)) == 6
+    # loading squashes the log down to a line per device
+    store.close()
+    DevNonceStore(path)
+    with open(path) as f:
+        assert len(f.readlines()) == 1
+
+
+@pytest.mark.asyncio
+async def test_next_async(tmp_path):
+    store = DevNonceStore(str(tmp_path / 'nonces.json'))
+    assert [await store.next_async('0000000000000001') for _ in range(3)] == [0, 1, 2]
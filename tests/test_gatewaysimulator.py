@@ -0,0 +1,21 @@
+import base64
+import json
+from tlwpy.gatewaysimulator import render_rxpk
+from tlwpy.radio import Channel
+
+
+def test_render_rxpk():
+    data = bytes(range(20))
+    rxpk = json.loads(render_rxpk(data, Channel(868.1, 0, 0), 'SF7BW125', 1234, -2.5, -100))
+    assert rxpk == {'tmst': 1234,
+                    'chan': 0,
+                    'rfch': 0,
+                    'freq': 868.1,
+                    'stat': 1,
+                    'modu': 'LORA',
+                    'datr': 'SF7BW125',
+                    'codr': '4/5',
+                    'lsnr': -2.5,
+                    'rssi': -100,
+                    'size': 20,
+                    'data': base64.b64encode(data).decode('ascii')}
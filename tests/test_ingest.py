@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import pytest
+from tlwpy.ingest import Ingestor, Message
+from tlwpy.queues import BoundedQueue, OverflowPolicy
+
+
+def decode_int(msg):
+    return int(msg.payload)
+
+
+@pytest.mark.asyncio
+async def test_decodes_in_order_from_another_thread():
+    seen = []
+    ingestor = Ingestor(asyncio.get_running_loop(), batch_size=4)
+
+    def network_thread():
+        for i in range(10):
+            ingestor.submit(decode_int, seen.append, Message('test', b'%d' % i))
+        ingestor.submit(decode_int, seen.append, Message('test', b'garbage'))
+
+    thread = threading.Thread(target=network_thread)
+    thread.start()
+    thread.join()
+    await asyncio.sleep(0.1)
+    assert seen == list(range(10))
+    assert ingestor.as_dict() == {'received': 11, 'pending': 0, 'dropped': 0, 'decode_errors': 1,
+                                   'sink_errors': 0}
+
+
+@pytest.mark.asyncio
+async def test_overflow_policies():
+    for policy, expected in [(OverflowPolicy.DROP_OLDEST, [2, 3]), (OverflowPolicy.DROP_NEWEST, [0, 1])]:
+        seen = []
+        ingestor = Ingestor(asyncio.get_running_loop(), max_pending=2, policy=policy)
+        # nothing drains until the loop gets a look in
+        for i in range(4):
+            ingestor.submit(decode_int, seen.append, Message('test', b'%d' % i))
+        await asyncio.sleep(0.1)
+        assert seen == expected
+        assert ingestor.dropped == 2
+
+
+@pytest.mark.asyncio
+async def test_blocking_sink_pushes_back():
+    queue = BoundedQueue(maxsize=2, policy=OverflowPolicy.BLOCK)
+    ingestor = Ingestor(asyncio.get_running_loop())
+    for i in range(4):
+        ingestor.submit(decode_int, queue.offer, Message('test', b'%d' % i))
+    await asyncio.sleep(0.1)
+    assert queue.qsize() == 2
+    assert [await queue.get() for _ in range(4)] == [0, 1, 2, 3]
+    assert queue.dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_failing_sink_doesnt_stop_delivery():
+    seen = []
+
+    def sink(value):
+        if value == 1:
+            raise ValueError('bad sink')
+        seen.append(value)
+
+    ingestor = Ingestor(asyncio.get_running_loop())
+    for i in range(3):
+        ingestor.submit(decode_int, sink, Message('test', b'%d' % i))
+    await asyncio.sleep(0.1)
+    ingestor.submit(decode_int, sink, Message('test', b'3'))
+    await asyncio.sleep(0.1)
+    assert seen == [0, 2, 3]
+    assert ingestor.sink_errors == 1
@@ -0,0 +1,171 @@
+import asyncio
+import base64
+import pytest
+from tlwpy.gatewaysimulator import Gateway
+from tlwpy.ingest import Ingestor
+from tlwpy.loadgen import LoadGenerator
+from tlwpy.loopback import topic_matches, LoopbackMessage, TlwbeStandIn
+from tlwpy.pktfwdbr import PacketForwarder
+from tlwpy.queues import OverflowPolicy
+from tlwpy.tlwbe import BulkResult, Result, Tlwbe, RESULT_OK
+from tlwpy.tracer import UplinkTracer
+
+
+def test_topic_matches():
+    assert topic_matches('a/+/c', 'a/b/c')
+    assert topic_matches('a/#', 'a/b/c')
+    assert topic_matches('a/#', 'a')
+    assert not topic_matches('a/+', 'a/b/c')
+    assert not topic_matches('#', '$SYS/broker')
+    assert not topic_matches('+/broker', '$SYS/broker')
+
+
+@pytest.mark.asyncio
+async def test_tlwbe_round_trip(loopback_broker):
+    standin = TlwbeStandIn(loopback_broker.client('tlwbe'))
+    tlwbe = loopback_broker.create(Tlwbe)
+    result = await tlwbe.add_dev('test', '0000000000000000', eui='0000000000000001')
+    assert result.code == RESULT_OK
+    result = await tlwbe.get_dev_by_eui('0000000000000001')
+    assert result.dev.name == 'test'
+    result = await tlwbe.list_devs()
+    assert result.eui_list == ['0000000000000001']
+    assert standin.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_results_arent_dropped_under_load(loopback_broker):
+    TlwbeStandIn(loopback_broker.client('tlwbe'))
+    ingestor = Ingestor(asyncio.get_running_loop(), max_pending=1, policy=OverflowPolicy.DROP_NEWEST)
+    tlwbe = loopback_broker.create(Tlwbe, ingestor=ingestor, timeout=1)
+    tlwbe.listen_for_all_uplinks()
+    backend = loopback_broker.client('backend')
+    request = asyncio.ensure_future(tlwbe.list_devs())
+    await asyncio.sleep(0)
+    # the result turns up behind a burst of uplinks that overflows the shared ingestor
+    for i in range(10):
+        backend.publish('tlwbe/uplink/0000000000000000/0000000000000001/1',
+                        '{"timestamp": 0, "port": 1, "payload": ""}')
+    result = await request
+    assert result.code == RESULT_OK
+    assert ingestor.dropped > 0
+
+
+@pytest.mark.asyncio
+async def test_simulator_end_to_end(loopback_broker):
+    # simulator, pktfwdbr and the tlwbe stand-in all in this loop, no broker or backend
+    standin = TlwbeStandIn(loopback_broker.client('tlwbe'))
+    tlwbe = loopback_broker.create(Tlwbe)
+    tlwbe.listen_for_all_uplinks()
+    pktfwdbr = loopback_broker.create(PacketForwarder, None, gateway_id='gw0',
+                                      disabled_queues=('joinreqs', 'uplinks'))
+    tracer = UplinkTracer()
+    gateway = loopback_broker.create(Gateway, gateway_id='gw0', pktfwdbr=pktfwdbr, tracer=tracer)
+    consumer = asyncio.ensure_future(tracer.consume(tlwbe.queue_uplinks))
+    try:
+        loadgen = LoadGenerator(gateway, tlwbe, '0000000000000001', 4, uplink_rate=40, payload_size=20)
+        report = await loadgen.run(0.5)
+        await asyncio.sleep(0.1)
+    finally:
+        consumer.cancel()
+    assert report.joined == 4
+    assert report.uplinks > 0
+    assert standin.joins == 4
+    assert standin.uplinks == report.uplinks
+    # every uplink came out of the stand-in decrypted and was matched up with what was sent
+    assert tracer.matched == report.uplinks
+    assert tracer.unexpected == 0
+
+
+@pytest.mark.asyncio
+async def test_request_timeout_and_late_result(loopback_broker):
+    # nothing answers, the request is only captured so its result can be sent after tlwbe has given up
+    tlwbe = loopback_broker.create(Tlwbe, timeout=0.1)
+    backend = loopback_broker.client('backend')
+    tokens = []
+    backend.subscribe('tlwbe/control/+/+/+')
+    backend.message_callback_add('tlwbe/control/+/+/+',
+                                 lambda client, userdata, msg: tokens.append(msg.topic.split('/')[-1]))
+    with pytest.raises(asyncio.TimeoutError):
+        await tlwbe.list_devs()
+    assert tlwbe.requests.timeouts == 1
+    # the token was evicted when the wait gave up
+    assert tlwbe.requests.in_flight == 0
+    assert len(tokens) == 1
+    backend.publish('tlwbe/control/result/%s' % tokens[0], '{"code": 0, "eui_list": []}')
+    await asyncio.sleep(0.1)
+    assert tlwbe.requests.late_results == 1
+    assert tlwbe.requests.completed == 0
+    assert tlwbe.requests.in_flight == 0
+
+
+def stored_uplink(i: int):
+    return {'timestamp': i, 'appeui': '0000000000000000', 'deveui': '0000000000000001', 'port': 1,
+            'payload': base64.b64encode(b'%d' % i).decode('ascii'), 'rfparams': {}}
+
+
+@pytest.mark.asyncio
+async def test_iter_uplinks_pages(loopback_broker):
+    standin = TlwbeStandIn(loopback_broker.client('tlwbe'))
+    standin.stored_uplinks.extend([stored_uplink(i) for i in range(25)])
+    tlwbe = loopback_broker.create(Tlwbe)
+    seen = []
+    async for uplink in tlwbe.iter_uplinks(page_size=10):
+        if len(seen) == 0:
+            # the second page is fetched while the first is still being worked through
+            await asyncio.sleep(0.1)
+            assert standin.requests == 2
+        seen.append(int(uplink.payload))
+    assert seen == list(range(25))
+    # 10, 10 and then a short page that ends it
+    assert standin.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_iter_uplinks_early_break(loopback_broker):
+    standin = TlwbeStandIn(loopback_broker.client('tlwbe'))
+    standin.stored_uplinks.extend([stored_uplink(i) for i in range(25)])
+    tlwbe = loopback_broker.create(Tlwbe)
+    seen = []
+    uplinks = tlwbe.iter_uplinks(page_size=10)
+    async for uplink in uplinks:
+        seen.append(int(uplink.payload))
+        if len(seen) == 3:
+            await asyncio.sleep(0)
+            break
+    await uplinks.aclose()
+    await asyncio.sleep(0.1)
+    assert seen == [0, 1, 2]
+    # the prefetch of the second page was given up on and nothing is left waiting
+    assert tlwbe.requests.cancelled == 1
+    assert tlwbe.requests.in_flight == 0
+    assert tlwbe.requests.completed == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_survives_failing_callback(loopback_broker):
+    standin = TlwbeStandIn(loopback_broker.client('tlwbe'))
+    tlwbe = loopback_broker.create(Tlwbe)
+    seen = []
+
+    def on_result(dev, result):
+        seen.append(dev[0])
+        if dev[0] == 'dev1':
+            raise ValueError('bad callback')
+
+    devs = [('dev%d' % i, '0000000000000000', '%016x' % i, None) for i in range(5)]
+    result = await tlwbe.add_devs(devs, on_result=on_result)
+    assert result.ok
+    assert result.callback_errors == 1
+    assert len(result.results) == 5
+    assert sorted(seen) == ['dev%d' % i for i in range(5)]
+    assert len(standin.devs) == 5
+
+
+def test_bulk_result_without_code():
+    results = [Result(LoopbackMessage('tlwbe/control/result/a', b'{"code": 0}')),
+               Result(LoopbackMessage('tlwbe/control/result/b', b'{}')),
+               Result(LoopbackMessage('tlwbe/control/result/c', b'garbage'))]
+    result = BulkResult(['a', 'b', 'c'], results)
+    assert not result.ok
+    assert [index for index, _, _ in result.failures] == [1, 2]
@@ -0,0 +1,60 @@
+import struct
+from tlwpy import lorawan
+from tlwpy.liblorawan import build_data
+
+KEY = bytes(range(16))
+
+
+def test_aes_decrypt_blocks():
+    # FIPS-197 appendix C.1
+    ciphertext = bytes.fromhex('69c4e0d86a7b0430d8cdb78070b4c55a')
+    assert lorawan.aes_decrypt_blocks(KEY, ciphertext) == bytes.fromhex('00112233445566778899aabbccddeeff')
+    blocks = bytes(range(32))
+    assert lorawan.aes_encrypt_blocks(KEY, lorawan.aes_decrypt_blocks(KEY, blocks)) == blocks
+
+
+def test_build_joinaccept():
+    joinaccept = lorawan.EncryptedJoinAccept(lorawan.build_joinaccept(KEY, 0xabcdef, 0x13, 0x26011234)).decrypt(KEY)
+    assert joinaccept.appnonce == 0xabcdef
+    assert joinaccept.netid == 0x13
+    assert joinaccept.devaddr == 0x26011234
+    assert joinaccept.rxdelay == 1
+
+
+def test_reconstruct_framecounter():
+    assert lorawan.reconstruct_framecounter(0x1234, 0x1000) == 0x1234
+    assert lorawan.reconstruct_framecounter(0xffff, 0xfffe) == 0xffff
+    # the bottom 16 bits going backwards means they wrapped
+    assert lorawan.reconstruct_framecounter(0x0000, 0xffff) == 0x10000
+    assert lorawan.reconstruct_framecounter(0x0005, 0x1fff0) == 0x20005
+    assert lorawan.reconstruct_framecounter(0x0005, 0x20001) == 0x20005
+
+
+def test_verify_mic_32bit_framecounter():
+    devaddr = 0x26011234
+    framecounter = 0x10005
+    # mhdr, devaddr, fctrl, the bottom 16 bits of the counter, port and some payload
+    msg = struct.pack('<BLBHB', lorawan.MHDR_MTYPE_UNCNFUP << lorawan.MHDR_MTYPE_SHIFT, devaddr, 0,
+                      framecounter & 0xffff, 1) + b'abcd'
+    mic = lorawan.calculate_data_mic(KEY, devaddr, framecounter, lorawan.DIRECTION_UP, msg)
+    uplink = lorawan.Uplink(msg + struct.pack('<L', mic))
+    assert uplink.framecounter == 0x0005
+    full = uplink.full_framecounter(0xfffe)
+    assert full == framecounter
+    assert uplink.verify_mic(KEY, full)
+    assert uplink.verify_mic(lorawan.SessionCrypto(KEY, KEY), full)
+    # the 16 bits from the frame alone aren't enough
+    assert not uplink.verify_mic(KEY)
+
+
+def test_decrypt_round_trip():
+    network_key = bytes(range(16, 32))
+    devaddr = 0x26011234
+    crypto = lorawan.SessionCrypto(network_key, KEY)
+    # more than one block of keystream, and port 0 which is encrypted with the network key
+    for port, payload in [(1, bytes(range(40))), (0, b'\x02\x03\x04')]:
+        data = build_data(int(lorawan.PacketType.UNCONFIRMED_UP), devaddr, 7, port, payload, network_key, KEY)
+        uplink = lorawan.Uplink(data)
+        assert uplink.port == port
+        assert uplink.verify_mic(crypto)
+        assert uplink.decrypt(crypto) == payload
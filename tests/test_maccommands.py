@@ -0,0 +1,20 @@
+import pytest
+import tlwpy.maccommands
+from tlwpy.maccommands import DIRECTION_UP, DIRECTION_DOWN
+
+
+def test_parse_downlink():
+    commands = tlwpy.maccommands.parse(bytes([0x02, 10, 3, 0x06]), DIRECTION_DOWN)
+    assert [command.name for command in commands] == ['LinkCheckAns', 'DevStatusReq']
+    assert commands[0].fields == {'margin': 10, 'gw_cnt': 3}
+
+
+def test_parse_uplink():
+    commands = tlwpy.maccommands.parse(bytes([0x03, 0b111, 0x06, 0xfe, 0x3f]), DIRECTION_UP)
+    assert commands[0].fields == {'power_ack': True, 'datarate_ack': True, 'chmask_ack': True}
+    assert commands[1].fields == {'battery': 254, 'margin': -1}
+
+
+def test_parse_truncated():
+    with pytest.raises(tlwpy.maccommands.MacCommandException):
+        tlwpy.maccommands.parse(bytes([0x03, 0x00]), DIRECTION_DOWN)
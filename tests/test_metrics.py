@@ -0,0 +1,26 @@
+from tlwpy.metrics import Histogram, Registry
+
+
+def test_histogram_window():
+    histogram = Histogram(window=100)
+    for i in range(1, 201):
+        histogram.observe(i)
+    summary = histogram.as_dict()
+    assert summary['count'] == 200
+    assert summary['min'] == 101
+    assert summary['p50'] == 150
+    assert summary['p99'] == 199
+
+
+def test_registry_merge_and_export():
+    first = Registry()
+    second = Registry()
+    first.counter('requests_total', operation='add').inc()
+    second.counter('requests_total', operation='add').inc(2)
+    second.histogram('request_seconds', operation='add').observe(0.5)
+    first.merge(second)
+    assert first.as_dict()['requests_total{operation="add"}'] == {'value': 3}
+    text = first.to_prometheus()
+    assert '# TYPE requests_total counter' in text
+    assert 'request_seconds{operation="add",quantile="0.5"} 0.5' in text
+    assert 'request_seconds_count{operation="add"} 1' in text
@@ -0,0 +1,63 @@
+import asyncio
+import base64
+import json
+import struct
+import pytest
+from tlwpy import lorawan
+from tlwpy.ingest import Message
+from tlwpy.pktfwdbr import decode_rx, PacketForwarder
+
+
+def rx_message(data: bytes):
+    return Message('pktfwdbr/gw/rx/unconfirmed', json.dumps({'data': base64.b64encode(data).decode('ascii')}))
+
+
+def test_decode_rx_joinreq():
+    data = bytes([0x00]) + struct.pack('<QQH', 1, 2, 3) + bytes(4)
+    join_req = decode_rx(rx_message(data))
+    assert isinstance(join_req, lorawan.JoinReq)
+    assert join_req.deveui == 2
+    assert join_req.devnonce == 3
+
+
+def test_decode_rx_uplink():
+    data = bytes([0x40]) + struct.pack('<IBHB', 0x01020304, 0, 7, 1) + b'abcd' + bytes(4)
+    uplink = decode_rx(rx_message(data))
+    assert isinstance(uplink, lorawan.Uplink)
+    assert uplink.devaddr == 0x01020304
+    assert uplink.framecounter == 7
+    assert uplink.port == 1
+
+
+def tx_payload(data: bytes):
+    return json.dumps({'txpk': {'data': base64.b64encode(data).decode('ascii')}})
+
+
+@pytest.mark.asyncio
+async def test_gateway_filter(loopback_broker):
+    pktfwdbr = loopback_broker.create(PacketForwarder, None, gateway_id='gw0')
+    backend = loopback_broker.client('backend')
+    for gateway, devaddr in [('gw1', 1), ('gw0', 2)]:
+        data = bytes([0x60]) + struct.pack('<IBHB', devaddr, 0, 0, 1) + b'abcd' + bytes(4)
+        backend.publish('pktfwdbr/%s/tx/%d' % (gateway, devaddr), tx_payload(data))
+    downlink = await asyncio.wait_for(pktfwdbr.downlinks.get(), 1)
+    assert downlink.devaddr == 2
+    await asyncio.sleep(0.1)
+    assert pktfwdbr.downlinks.empty()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_joins(loopback_broker):
+    pktfwdbr = loopback_broker.create(PacketForwarder, None, gateway_id='gw0')
+    backend = loopback_broker.client('backend')
+    keys = dict(('%016x' % i, bytes([i]) * 16) for i in range(1, 5))
+    futures = dict((dev_eui, pktfwdbr.expect_joinack(dev_eui, key)) for dev_eui, key in keys.items())
+    # answered in the reverse order they were started in
+    for i, (dev_eui, key) in enumerate(reversed(list(keys.items()))):
+        joinaccept = lorawan.build_joinaccept(key, i, 0x13, int(dev_eui, 16))
+        backend.publish('pktfwdbr/gw0/tx/%d' % i, tx_payload(joinaccept))
+    for dev_eui, future in futures.items():
+        joinaccept = await pktfwdbr.wait_for_joinack(future, 1)
+        assert joinaccept.devaddr == int(dev_eui, 16)
+    # nothing was left over for the unmatched queue
+    assert pktfwdbr.joinacks.empty()
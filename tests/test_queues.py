@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+from tlwpy.queues import BoundedQueue, OverflowPolicy, create_queue
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest():
+    queue = BoundedQueue(maxsize=2)
+    for i in range(5):
+        assert queue.offer(i) is None
+    assert [queue.get_nowait(), queue.get_nowait()] == [3, 4]
+    assert queue.as_dict() == {'size': 0, 'maxsize': 2, 'enqueued': 5, 'dropped': 3}
+
+
+@pytest.mark.asyncio
+async def test_drop_newest():
+    queue = BoundedQueue(maxsize=2, policy=OverflowPolicy.DROP_NEWEST)
+    for i in range(5):
+        queue.offer(i)
+    assert [queue.get_nowait(), queue.get_nowait()] == [0, 1]
+    assert queue.dropped == 3
+
+
+@pytest.mark.asyncio
+async def test_block():
+    queue = BoundedQueue(maxsize=1, policy=OverflowPolicy.BLOCK)
+    assert queue.offer(0) is None
+    put = asyncio.ensure_future(queue.offer(1))
+    await asyncio.sleep(0)
+    assert not put.done()
+    assert queue.get_nowait() == 0
+    await put
+    assert queue.get_nowait() == 1
+
+
+def test_disabled():
+    assert create_queue('uplinks', ('uplinks',)) is None
@@ -0,0 +1,19 @@
+from tlwpy.radio import Radio, EU868, TMST_MASK, LSNR_MIN, LSNR_MAX
+
+
+def test_channel_plan():
+    freqs = [channel.freq for channel in EU868.channels]
+    assert freqs[:3] == [868.1, 868.3, 868.5]
+    assert [channel.rfch for channel in EU868.channels] == [0, 0, 0, 0, 1, 1, 1, 1]
+    channel, datr = EU868.pick()
+    assert channel in EU868.channels
+    assert datr in EU868.datarates
+
+
+def test_radio():
+    radio = Radio(rssi=-100, lsnr=5, rssi_spread=10, lsnr_spread=30, tmst_offset=TMST_MASK)
+    assert radio.tmst(1.0) == 999999
+    for _ in range(100):
+        assert LSNR_MIN <= radio.sample_lsnr() <= LSNR_MAX
+        assert isinstance(radio.sample_rssi(), int)
+    assert Radio().sample_rssi() == -48
@@ -0,0 +1,83 @@
+import asyncio
+import pytest
+import queue
+from tlwpy.rak811 import ResponseParser, Recv, CommandResult, Status, AsyncRak811
+
+
+def test_parser_incremental():
+    parser = ResponseParser()
+    results = parser.feed(b'OK\r\nat+recv=0,2,-40,7,2,ab')
+    assert len(results) == 1 and results[0].ok
+    results = parser.feed(b'cd\r\nat+recv=2,0,0\r\n')
+    assert isinstance(results[0], Recv)
+    assert results[0].status == Status.RECV_DATA
+    assert results[0].port == 2
+    assert results[0].rssi == -40
+    assert results[0].snr == 7
+    assert results[0].payload == b'\xab\xcd'
+    assert results[1].status == Status.TX_UNCOMFIRMED
+
+
+def test_parser_results():
+    results = ResponseParser().feed(b'OK1.0.2\r\nERROR-1\r\n')
+    assert isinstance(results[0], CommandResult)
+    assert results[0].ok and results[0].value == '1.0.2'
+    assert not results[1].ok and results[1].value == '-1'
+
+
+def test_parser_bad_line():
+    parser = ResponseParser()
+    # the length says 5 bytes but there's only 2
+    results = parser.feed(b'OK\r\nat+recv=0,1,-40,5,3,aabb\r\n')
+    assert len(results) == 1 and results[0].ok
+    assert parser.errors == 1
+    # odd number of hex digits
+    results = parser.feed(b'at+recv=0,1,-40,5,1,abc\r\nat+recv=2,0,0\r\n')
+    assert len(results) == 1 and results[0].status == Status.TX_UNCOMFIRMED
+    assert parser.errors == 2
+
+
+class FakePort:
+    # just enough of serial.Serial for AsyncRak811, replies to each command with the next canned response
+    def __init__(self, responses: list):
+        self.__responses = responses
+        self.__pending = queue.Queue()
+
+    def push(self, data: bytes):
+        for b in data:
+            self.__pending.put(bytes([b]))
+
+    def read(self, size: int = 1):
+        chunk = b''
+        try:
+            chunk = self.__pending.get(timeout=0.05)
+            while len(chunk) < size:
+                chunk += self.__pending.get_nowait()
+        except queue.Empty:
+            pass
+        return chunk
+
+    @property
+    def in_waiting(self):
+        return self.__pending.qsize()
+
+    def write(self, line: bytes):
+        if len(self.__responses) > 0:
+            self.push(self.__responses.pop(0))
+
+    def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_async_stale_results():
+    port = FakePort([b'OK1.0.2\r\n', b'OK\r\nat+recv=2,0,0\r\n'])
+    async with AsyncRak811(port) as rak811:
+        # leftovers from a command and a send that timed out along with a garbled line
+        port.push(b'OKlate\r\nat+recv=0,1,-40,5,3,aabb\r\nat+recv=1,0,0\r\n')
+        await asyncio.sleep(0.2)
+        result = await rak811.get_version()
+        assert result.value == '1.0.2'
+        status, downlinks = await rak811.send(1, b'\x01', timeout=1)
+        assert status == Status.TX_UNCOMFIRMED
+        assert len(downlinks) == 0
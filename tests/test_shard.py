@@ -0,0 +1,36 @@
+from tlwpy.loadgen import Report, STAGE_UPLINK
+from tlwpy.shard import Coordinator, generate_credentials, partition
+
+
+def test_partition():
+    credentials = generate_credentials(10, eui_base=0)
+    parts = partition(credentials, 3)
+    assert [len(part) for part in parts] == [4, 3, 3]
+    assert sorted(sum(parts, [])) == sorted(credentials)
+    # more shards than nodes doesn't create empty shards
+    assert len(partition(credentials, 20)) == 10
+
+
+def test_rate_follows_nodes():
+    coordinator = Coordinator('localhost', None, '00' * 8, generate_credentials(10), 20, shards=3)
+    configs = coordinator.configs()
+    assert [config.gateway_id for config in configs] == ['shardgw0', 'shardgw1', 'shardgw2']
+    assert [config.uplink_rate for config in configs] == [8, 6, 6]
+
+
+def test_report_merge():
+    first = Report(2)
+    second = Report(3)
+    first.uplinks = 10
+    first.duration = 5.0
+    first.latencies[STAGE_UPLINK].observe(0.1)
+    second.uplinks = 20
+    second.duration = 6.0
+    second.latencies[STAGE_UPLINK].observe(0.3)
+    first.merge(second)
+    assert first.nodes == 5
+    assert first.uplinks == 30
+    # the shards ran side by side
+    assert first.duration == 6.0
+    assert first.uplinks_per_second == 5.0
+    assert first.latencies[STAGE_UPLINK].count == 2
@@ -0,0 +1,44 @@
+import base64
+from tlwpy.tlwbe import Uplink
+from tlwpy.tracer import UplinkTracer, DownlinkTracer
+
+
+def uplink(dev_eui: str, port: int, payload: bytes):
+    return Uplink({'timestamp': 0, 'appeui': '0000000000000000', 'deveui': dev_eui, 'port': port,
+                   'payload': base64.b64encode(payload).decode('ascii')})
+
+
+def test_match():
+    tracer = UplinkTracer()
+    tracer.track('000000000000000A', 1, b'one', 0x1, 0)
+    tracer.track('000000000000000a', 1, b'one', 0x1, 1)
+    assert tracer.received(uplink('000000000000000a', 1, b'one')) is not None
+    assert tracer.received(uplink('000000000000000a', 2, b'one')) is None
+    stats = tracer.as_dict()
+    assert stats['matched'] == 1
+    assert stats['unexpected'] == 1
+    assert stats['in_flight'] == 1
+    assert stats['latency']['count'] == 1
+
+
+def test_lost():
+    tracer = UplinkTracer(timeout=0)
+    tracer.track('000000000000000a', 1, b'one', 0x1, 0)
+    tracer.track('000000000000000a', 1, None, 0x1, 1)
+    stats = tracer.as_dict()
+    assert stats['lost'] == 2
+    assert stats['in_flight'] == 0
+    assert stats['loss_rate'] == 1.0
+
+
+def test_downlink_match():
+    tracer = DownlinkTracer()
+    tracer.track('000000000000000A', 3, b'down')
+    tracer.track('000000000000000a', 3, None)
+    assert tracer.captured('000000000000000a', 3, b'down') is not None
+    assert tracer.captured('000000000000000a', 3, b'') is not None
+    assert tracer.captured('000000000000000a', 3, b'down') is None
+    stats = tracer.as_dict()
+    assert stats['matched'] == 2
+    assert stats['unexpected'] == 1
+    assert tracer.metrics.as_dict()['downlink_latency_seconds']['count'] == 2
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import random
+import threading
+
+DEVNONCE_MAX = 0xffff
+
+DEFAULT_RESERVE = 1
+
+
+class NoncesExhaustedException(Exception):
+    pass
+
+
+class DevNonceStore:
+    __slots__ = ['__path', '__random', '__autosave', '__reserve', '__issued', '__reserved', '__permutations',
+                 '__log', '__log_lock']
+
+    def __init__(self, path: str = None, random_nonces: bool = False, autosave: bool = True,
+                 reserve: int = DEFAULT_RESERVE):
+        # the file is an append only log of how far each device's nonces have been handed out.
+        # reserve is how many nonces each write covers, after a crash up to that many are skipped
+        # but none are ever reused, bigger means fewer writes when lots of devices are rejoining
+        assert reserve > 0
+        self.__path = path
+        self.__random = random_nonces
+        self.__autosave = autosave
+        self.__reserve = reserve
+        self.__issued = {}
+        self.__reserved = {}
+        self.__permutations = {}
+        self.__log = None
+        self.__log_lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.__path, 'r') as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+                record = json.loads(line)
+                dev_eui = record['eui']
+                # anything that was reserved might have been used
+                self.__issued[dev_eui] = max(self.__issued.get(dev_eui, 0), record['issued'])
+                self.__reserved[dev_eui] = self.__issued[dev_eui]
+                if 'permutation' in record:
+                    self.__permutations[dev_eui] = tuple(record['permutation'])
+        # squash the log down to one line per device
+        self.save()
+
+    def __record(self, dev_eui: str, issued: int):
+        record = {'eui': dev_eui, 'issued': issued}
+        if dev_eui in self.__permutations:
+            record['permutation'] = list(self.__permutations[dev_eui])
+        return json.dumps(record) + '\n'
+
+    def save(self):
+        assert self.__path is not None
+        # write then rename so a crash mid-save can't lose the nonces already handed out
+        tmp_path = '%s.tmp' % self.__path
+        with self.__log_lock:
+            with open(tmp_path, 'w') as f:
+                for dev_eui, issued in self.__issued.items():
+                    f.write(self.__record(dev_eui, max(issued, self.__reserved.get(dev_eui, 0))))
+            if self.__log is not None:
+                self.__log.close()
+                self.__log = None
+            os.replace(tmp_path, self.__path)
+
+    def close(self):
+        with self.__log_lock:
+            if self.__log is not None:
+                self.__log.close()
+                self.__log = None
+
+    def __append(self, records: str):
+        # can be called from an executor thread so the writes are serialised here
+        with self.__log_lock:
+            if self.__log is None:
+                self.__log = open(self.__path, 'a')
+            self.__log.write(records)
+            self.__log.flush()
+
+    def __permute(self, dev_eui: str, index: int):
+        # an odd multiplier makes this a bijection over the 16 bit nonce space so
+        # walking the index gives random looking nonces that never repeat
+        permutation = self.__permutations.get(dev_eui)
+        if permutation is None:
+            permutation = (random.getrandbits(16) | 1, random.getrandbits(16))
+            self.__permutations[dev_eui] = permutation
+        multiplier, offset = permutation
+        return (index * multiplier + offset) & DEVNONCE_MAX
+
+    def __take(self, dev_eui: str):
+        # returns the nonce and whatever has to be written before it can be used, if anything
+        index = self.__issued.get(dev_eui, 0)
+        if index > DEVNONCE_MAX:
+            raise NoncesExhaustedException('no devnonces left for %s' % dev_eui)
+        self.__issued[dev_eui] = index + 1
+        if self.__random:
+            nonce = self.__permute(dev_eui, index)
+        else:
+            nonce = index
+        record = None
+        if self.__path is not None and self.__autosave and index >= self.__reserved.get(dev_eui, 0):
+            reserved = min(index + self.__reserve, DEVNONCE_MAX + 1)
+            self.__reserved[dev_eui] = reserved
+            record = self.__record(dev_eui, reserved)
+        return nonce, record
+
+    def next(self, dev_eui: str):
+        nonce, record = self.__take(dev_eui.lower())
+        if record is not None:
+            self.__append(record)
+        return nonce
+
+    async def next_async(self, dev_eui: str):
+        # same as next() but any file writing happens off the loop
+        nonce, record = self.__take(dev_eui.lower())
+        if record is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.__append, record)
+        return nonce
+
+    def forget(self, dev_eui: str):
+        dev_eui = dev_eui.lower()
+        self.__issued.pop(dev_eui, None)
+        self.__reserved.pop(dev_eui, None)
+        self.__permutations.pop(dev_eui, None)
+        if self.__path is not None and self.__autosave:
+            self.save()
@@ -3,64 +3,186 @@ from mqttbase import MqttBase
 import json
 import tlwpy.liblorawan
 import tlwpy.pktfwdbr
+from tlwpy.devnonce import DevNonceStore
+from tlwpy.ingest import Ingestor
+from tlwpy.metrics import Registry
+from tlwpy.tracer import UplinkTracer, DownlinkTracer
+from tlwpy.radio import Channel, ChannelPlan, Radio, DEFAULT_CHANNEL, DEFAULT_DATARATE
 import base64
 import asyncio
-from tlwpy.lorawan import PacketType, JoinAccept, SessionKeys, Downlink
+import random
+import time
+from functools import lru_cache
+from tlwpy.lorawan import PacketType, JoinAccept, SessionKeys, SessionCrypto, Downlink, FCNT32_MASK
 import logging
 
 PKTFWDBRROOT = 'pktfwdbr'
 RX_TYPE_JOIN = 'join'
 RX_TYPE_UNCONFIRMED = 'unconfirmed'
 
+DEFAULT_SKEW = 0.01
+
+RXPK_TEMPLATE_CACHE_SIZE = 256
+
+
+@lru_cache(maxsize=RXPK_TEMPLATE_CACHE_SIZE)
+def rxpk_template(chan: int, rfch: int, freq: float, datr: str):
+    # everything that's the same for every frame on a channel and datarate is rendered once,
+    # the per frame fields get spliced onto the end with a single format
+    constant = json.dumps({"chan": chan,
+                           "rfch": rfch,
+                           "freq": freq,
+                           "stat": 1,
+                           "modu": "LORA",
+                           "datr": datr,
+                           "codr": "4/5"}, separators=(',', ':'))
+    return constant[:-1].replace('%', '%%') + ',"tmst":%d,"lsnr":%r,"rssi":%d,"size":%d,"data":"%s"}'
+
+
+def render_rxpk(data: bytes, channel: Channel, datr: str, tmst: int, lsnr: float, rssi: int):
+    template = rxpk_template(channel.chan, channel.rfch, channel.freq, datr)
+    return (template % (tmst, lsnr, rssi, len(data), base64.b64encode(data).decode('ascii'))).encode('ascii')
+
 
 class Gateway(MqttBase):
-    __slots__ = ['__gateway_id', '__pktfwdbr']
+    __slots__ = ['__gateway_id', '__pktfwdbr', '__pktfwdbr_args', '__nonce_store', '__nodes', 'metrics', 'tracer',
+                 'downlink_tracer', 'channel_plan', 'radio', 'skew', 'neighbours', '__relays', '__rx_topic']
 
-    def __init__(self, host: str = None, port: int = None, gateway_id: str = None):
+    def __init__(self, host: str = None, port: int = None, gateway_id: str = None,
+                 nonce_store: DevNonceStore = None, ingestor: Ingestor = None, metrics: Registry = None,
+                 tracer: UplinkTracer = None, pktfwdbr: tlwpy.pktfwdbr.PacketForwarder = None,
+                 channel_plan: ChannelPlan = None, radio: Radio = None, skew: float = DEFAULT_SKEW,
+                 downlink_tracer: DownlinkTracer = None):
         super(Gateway, self).__init__(host, port, id=mqttbase.create_client_id("gwsim"))
         if gateway_id is not None:
             self.__gateway_id = gateway_id
         else:
             self.__gateway_id = 'fakegw'
+        self.__rx_topic = '%s/%s/rx/' % (PKTFWDBRROOT, self.__gateway_id)
+
+        self.__nonce_store = nonce_store if nonce_store is not None else DevNonceStore()
+        self.metrics = metrics if metrics is not None else Registry()
+        self.tracer = tracer
+        self.downlink_tracer = downlink_tracer
+        self.__nodes = {}
+        # without a plan every frame goes out on the same channel and datarate
+        self.channel_plan = channel_plan
+        self.radio = radio if radio is not None else Radio()
+        # other gateways that hear everything this one sends, each within skew seconds of it
+        self.neighbours = []
+        self.skew = skew
+        self.__relays = set()
+        # gateways that are only there to be neighbours never need to see tx so the
+        # forwarder isn't created until something needs it
+        self.__pktfwdbr = pktfwdbr
+        self.__pktfwdbr_args = (host, port, ingestor)
+        if pktfwdbr is not None:
+            pktfwdbr.downlink_router = self.__route_downlink
+
+    @property
+    def gateway_id(self):
+        return self.__gateway_id
 
-        self.__pktfwdbr = tlwpy.pktfwdbr.PacketForwarder(host=host, port=port)
+    def __get_pktfwdbr(self):
+        if self.__pktfwdbr is None:
+            host, port, ingestor = self.__pktfwdbr_args
+            # the simulator hears its own uplinks, nothing reads them so don't bother parsing them.
+            # only this gateway's tx matters, other simulators' join accepts would just be trial decrypted
+            self.__pktfwdbr = tlwpy.pktfwdbr.PacketForwarder(host=host, port=port, ingestor=ingestor,
+                                                             disabled_queues=('joinreqs', 'uplinks'),
+                                                             gateway_id=self.__gateway_id)
+            self.__pktfwdbr.downlink_router = self.__route_downlink
+        return self.__pktfwdbr
+
+    def add_neighbour(self, gateway):
+        self.neighbours.append(gateway)
+
+    def __route_downlink(self, downlink: Downlink):
+        node = self.__nodes.get(downlink.devaddr)
+        if node is None:
+            return False
+        if self.downlink_tracer is not None:
+            # has to happen before delivery moves the node's downlink counter on
+            self.downlink_tracer.captured(node.dev_eui, downlink.port, node.decrypt_downlink(downlink))
+        node.deliver_downlink(downlink)
+        return True
+
+    def register_node(self, dev_addr: int, node):
+        self.__nodes[dev_addr] = node
+
+    def unregister_node(self, dev_addr: int, node):
+        if self.__nodes.get(dev_addr) is node:
+            self.__nodes.pop(dev_addr)
+
+    def __trace_uplink(self, dev_addr: int, framecounter: int, port: int, payload: bytes):
+        # only uplinks from registered nodes can be traced as the tracer needs the dev eui
+        node = self.__nodes.get(dev_addr)
+        if node is not None:
+            self.tracer.track(node.dev_eui, port, payload, dev_addr, framecounter)
 
     async def send_pktfwdbr_publish(self, topic, payload):
         await self.wait_for_connection()
         self.mqtt_client.publish(topic, json.dumps(payload))
 
-    def __create_tx_json(self, data: bytes):
-        payload = {"tmst": 3889331076,
-                   "chan": 1,
-                   "rfch": 0,
-                   "freq": 923.39999999999998,
-                   "stat": 1,
-                   "modu": "LORA",
-                   "datr": "SF10BW125",
-                   "codr": "4/5",
-                   "lsnr": 12.0,
-                   "rssi": -48,
-                   "size": len(data),
-                   "data": base64.b64encode(data).decode('ascii')}
-        return payload
-
-    async def join(self, app_eui: str, dev_eui: str, dev_key: str):
+    async def publish_rx(self, path: str, data: bytes, channel: Channel, datr: str, received_at: float = None):
+        rxpk = render_rxpk(data, channel, datr, self.radio.tmst(received_at), self.radio.sample_lsnr(),
+                           self.radio.sample_rssi())
+        await self.wait_for_connection()
+        self.mqtt_client.publish(self.__rx_topic + path, rxpk)
+
+    async def __relay(self, gateway, path: str, data: bytes, channel: Channel, datr: str, received_at: float):
+        await asyncio.sleep(random.uniform(0, self.skew))
+        await gateway.publish_rx(path, data, channel, datr, received_at)
+
+    def __relay_done(self, task: asyncio.Task):
+        self.__relays.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger('gwsim').warning('relaying to a neighbour failed: %s' % repr(task.exception()))
+
+    async def __send_rx(self, path: str, data: bytes):
+        # the channel and datarate belong to the transmission so every gateway that hears it agrees on them
+        if self.channel_plan is not None:
+            channel, datr = self.channel_plan.pick()
+        else:
+            channel, datr = DEFAULT_CHANNEL, DEFAULT_DATARATE
+        received_at = time.monotonic()
+        # the node shouldn't have to wait for the slowest neighbour before it can send again
+        for gateway in self.neighbours:
+            task = asyncio.ensure_future(self.__relay(gateway, path, data, channel, datr, received_at))
+            self.__relays.add(task)
+            task.add_done_callback(self.__relay_done)
+        await self.publish_rx(path, data, channel, datr, received_at)
+
+    async def join(self, app_eui: str, dev_eui: str, dev_key: str, timeout: float = 10, dev_nonce: int = None):
         assert len(app_eui) is 16
         assert len(dev_eui) is 16
-        topic = '%s/%s/rx/%s/%s/%s' % (PKTFWDBRROOT, self.__gateway_id, RX_TYPE_JOIN, app_eui, dev_eui)
+        path = '%s/%s/%s' % (RX_TYPE_JOIN, app_eui, dev_eui)
 
         bin_dev_key = bytes.fromhex(dev_key)
 
-        dev_nonce = 0
+        if dev_nonce is None:
+            dev_nonce = await self.__nonce_store.next_async(dev_eui)
 
         data = tlwpy.liblorawan.build_joinreq(bin_dev_key, bytes.fromhex(app_eui), bytes.fromhex(dev_eui), dev_nonce)
 
-        payload = self.__create_tx_json(data)
-
-        await self.send_pktfwdbr_publish(topic, payload)
+        pktfwdbr = self.__get_pktfwdbr()
+        await pktfwdbr.wait_for_connection()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        joinack_future = pktfwdbr.expect_joinack(dev_eui, bin_dev_key)
+        try:
+            await self.__send_rx(path, data)
+        except BaseException:
+            joinack_future.cancel()
+            raise
 
-        encrypted_joinack = await asyncio.wait_for(self.__pktfwdbr.joinacks.get(), 10)
-        joinack: JoinAccept = encrypted_joinack.decrypt(bin_dev_key)
+        try:
+            joinack: JoinAccept = await pktfwdbr.wait_for_joinack(joinack_future, timeout)
+        except asyncio.TimeoutError:
+            self.metrics.counter('gateway_joins_total', outcome='timeout').inc()
+            raise
+        self.metrics.counter('gateway_joins_total', outcome='ok').inc()
+        self.metrics.histogram('gateway_join_seconds').observe(loop.time() - start)
 
         session_keys = SessionKeys(bin_dev_key, joinack.appnonce, joinack.netid, dev_nonce)
 
@@ -71,11 +193,12 @@ class Gateway(MqttBase):
 
         packet_type = PacketType.CONFIRMED_UP if confirmed else PacketType.UNCONFIRMED_UP
 
-        topic = '%s/%s/rx/%s' % (PKTFWDBRROOT, self.__gateway_id, RX_TYPE_UNCONFIRMED)
+        # straight to liblorawan, until it can hold an expanded key a SessionCrypto has nothing to add here
         data = tlwpy.liblorawan.build_data(int(packet_type), dev_addr, framecounter, port, payload, network_key,
                                            application_key)
-        payload = self.__create_tx_json(data)
-        await self.send_pktfwdbr_publish(topic, payload)
+        if self.tracer is not None:
+            self.__trace_uplink(dev_addr, framecounter, port, payload)
+        await self.__send_rx(RX_TYPE_UNCONFIRMED, data)
 
     async def send_txack(self, token):
         topic = '%s/%s/txack/%s' % (PKTFWDBRROOT, self.__gateway_id, token)
@@ -83,31 +206,72 @@ class Gateway(MqttBase):
         await self.send_pktfwdbr_publish(topic, payload)
 
 
+def create_cluster(count: int, host: str = None, port: int = None, gateway_id: str = 'fakegw',
+                   channel_plan: ChannelPlan = None, skew: float = DEFAULT_SKEW, rssi_spread: float = 4,
+                   lsnr_spread: float = 2, gateway_class=Gateway, **kwargs):
+    # count gateways that all hear the same frames, nodes should use the first one that's returned.
+    # each gateway is at its own distance from the nodes so gets its own average signal
+    gateways = []
+    for i in range(count):
+        radio = Radio(rssi=random.randint(-120, -50), lsnr=round(random.uniform(-10, 12), 1),
+                      rssi_spread=rssi_spread, lsnr_spread=lsnr_spread)
+        gateway_kwargs = kwargs if i == 0 else {}
+        gateways.append(gateway_class(host, port, gateway_id='%s%d' % (gateway_id, i), channel_plan=channel_plan,
+                                      radio=radio, skew=skew, **gateway_kwargs))
+    for neighbour in gateways[1:]:
+        gateways[0].add_neighbour(neighbour)
+    return gateways
+
+
 class Node:
     __slots__ = ['app_eui', 'dev_eui', 'key', '__gateway', '__dev_addr', '__frame_counter', '__network_key',
-                 '__app_key', 'downlinks']
+                 '__app_key', '__crypto', 'downlinks', '__downlink_queue', 'dropped_downlinks', '__downlink_frame_counter']
 
-    def __init__(self, gateway: Gateway, app_eui: str, dev_eui: str, key: str):
+    def __init__(self, gateway: Gateway, app_eui: str, dev_eui: str, key: str, max_downlinks: int = 64):
         self.__gateway = gateway
         self.__dev_addr = None
         self.__frame_counter = 0
+        self.__downlink_frame_counter = 0
         self.__network_key = None
         self.__app_key = None
+        self.__crypto = None
         self.app_eui = app_eui
         self.dev_eui = dev_eui
         self.key = key
         self.downlinks = []
+        self.__downlink_queue = asyncio.Queue(maxsize=max_downlinks)
+        self.dropped_downlinks = 0
+
+    @property
+    def dev_addr(self):
+        return self.__dev_addr
+
+    @property
+    def frame_counter(self):
+        return self.__frame_counter
+
+    @property
+    def downlink_frame_counter(self):
+        return self.__downlink_frame_counter
 
     async def join(self):
         dev_addr, network_key, app_key = await self.__gateway.join(self.app_eui, self.dev_eui, self.key)
         assert 0 <= dev_addr <= 0xffffffff
         assert len(network_key) is 16
         assert len(app_key) is 16
+        if self.__dev_addr is not None:
+            self.__gateway.unregister_node(self.__dev_addr, self)
         self.__dev_addr = dev_addr
+        self.__frame_counter = 0
+        self.__downlink_frame_counter = 0
         self.__network_key = network_key
         self.__app_key = app_key
+        self.__crypto = SessionCrypto(network_key, app_key)
+        self.__gateway.register_node(dev_addr, self)
 
     async def send_uplink(self, port: int, confirmed=False, payload: bytes = None):
+        # the counter can't wrap within a session, once it's used up the node has to rejoin
+        assert self.__frame_counter <= FCNT32_MASK, 'frame counter exhausted for %s, rejoin needed' % self.dev_eui
         await self.__gateway.send_uplink(self.__dev_addr, self.__frame_counter, port, self.__network_key,
                                          self.__app_key, confirmed=confirmed, payload=payload)
         self.__frame_counter += 1
@@ -120,3 +284,18 @@ class Node:
         #    logging.debug('downlink mic is incorrect')
         else:
             logging.debug('downlink is not for this node(%x), is for (%x)' % (self.__dev_addr, downlink.devaddr))
+
+    def decrypt_downlink(self, downlink: Downlink):
+        framecounter = downlink.full_framecounter(self.__downlink_frame_counter)
+        return downlink.decrypt(self.__crypto, framecounter)
+
+    def deliver_downlink(self, downlink: Downlink):
+        self.__downlink_frame_counter = downlink.full_framecounter(self.__downlink_frame_counter)
+        # a node that isn't being drained shouldn't hold on to every downlink it was ever sent
+        if self.__downlink_queue.full():
+            self.__downlink_queue.get_nowait()
+            self.dropped_downlinks += 1
+        self.__downlink_queue.put_nowait(downlink)
+
+    async def wait_for_downlink(self, timeout: float = None):
+        return await asyncio.wait_for(self.__downlink_queue.get(), timeout)
@@ -1,37 +1,50 @@
 import logging
 import mqttbase
 from mqttbase import MqttBase
-from asyncio import Queue
 import asyncio
 import json
+from tlwpy.ingest import Ingestor
+from tlwpy.queues import OverflowPolicy, BoundedQueue, DEFAULT_MAXSIZE
 
 TOPICROOT = 'gwctrl'
 HEARTBEAT = 'heartbeat'
 CTRL_REBOOT = 'reboot'
 
 
+def decode_heartbeat(msg):
+    heartbeat_json = json.loads(msg.payload)
+    return heartbeat_json['sysinfo']['uptime']
+
+
 class Gateway(MqttBase):
-    __slots__ = ['gwid', '__logger', '__last_uptime', '__reboot_queue']
+    __slots__ = ['gwid', '__logger', '__last_uptime', '__reboot_queue', '__ingestor']
 
     def __on_heartbeat(self, client, userdata, msg):
-        self.__logger.debug("saw gateway heartbeat")
-        heartbeat_json = json.loads(msg.payload)
+        self.__ingestor.submit(decode_heartbeat, self.__on_uptime, msg)
 
-        uptime = heartbeat_json['sysinfo']['uptime']
-        if uptime < self.__last_uptime:
-            self.__logger.debug('gateway uptime went backwards, probably rebooted')
-            self.event_loop.call_soon_threadsafe(self.__reboot_queue.put_nowait, True)
+    def __on_uptime(self, uptime: int):
+        self.__logger.debug("saw gateway heartbeat")
+        last_uptime = self.__last_uptime
         self.__last_uptime = uptime
+        if uptime < last_uptime:
+            self.__logger.debug('gateway uptime went backwards, probably rebooted')
+            return self.__reboot_queue.offer(True)
+        return None
 
-    def __init__(self, host: str, gwid: str):
+    def __init__(self, host: str, gwid: str, ingestor: Ingestor = None, queue_maxsize: int = DEFAULT_MAXSIZE,
+                 queue_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
         self.__last_uptime = -1
-        self.__reboot_queue = Queue()
+        self.__reboot_queue = BoundedQueue(queue_maxsize, queue_policy)
         self.gwid = gwid
         heartbeat_topic = '%s/%s/%s' % (TOPICROOT, gwid, HEARTBEAT)
         super().__init__(host, id=mqttbase.create_client_id('gwctrl'), topics=[heartbeat_topic])
         self.__logger = logging.getLogger('gwctrl')
+        self.__ingestor = ingestor if ingestor is not None else Ingestor(self.event_loop)
         self.mqtt_client.message_callback_add(heartbeat_topic, self.__on_heartbeat)
 
+    def queue_stats(self):
+        return {'reboot': self.__reboot_queue.as_dict()}
+
     async def reboot(self):
         self.__logger.debug('triggering gateway reboot')
         self.mqtt_client.publish('%s/%s/ctrl/%s' % (TOPICROOT, self.gwid, CTRL_REBOOT))
@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import logging
+import threading
+from tlwpy.queues import OverflowPolicy
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_PENDING = 10000
+
+
+class Message:
+    __slots__ = ['topic', 'payload']
+
+    # a copy of the parts of a paho MQTTMessage that decoders use, unlike
+    # the original it can be pickled so decoding can happen in another process
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+def decode_batch(batch: list):
+    results = []
+    for decoder, msg in batch:
+        try:
+            results.append(decoder(msg))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class Ingestor:
+    __slots__ = ['__loop', '__executor', '__batch_size', '__max_pending', '__policy', '__lock', '__not_full',
+                 '__pending', '__draining', '__logger', 'received', 'dropped', 'decode_errors', 'sink_errors']
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, executor=None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_pending: int = DEFAULT_MAX_PENDING, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+        # executor can be a thread or process pool, without one decoding happens on the loop.
+        # max_pending of 0 means nothing is ever dropped or blocked
+        self.__loop = loop
+        self.__executor = executor
+        self.__batch_size = batch_size
+        self.__max_pending = max_pending
+        self.__policy = policy
+        self.__lock = threading.Lock()
+        self.__not_full = threading.Condition(self.__lock)
+        self.__pending = collections.deque()
+        self.__draining = False
+        self.__logger = logging.getLogger('ingest')
+        self.received = 0
+        self.dropped = 0
+        self.decode_errors = 0
+        self.sink_errors = 0
+
+    def submit(self, decoder, sink, msg):
+        # called from the network thread, decoder gets run somewhere else and
+        # whatever it returns is passed to sink on the loop, None means drop it
+        with self.__lock:
+            self.received += 1
+            if 0 < self.__max_pending <= len(self.__pending):
+                if self.__policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.__policy == OverflowPolicy.DROP_OLDEST:
+                    self.__pending.popleft()
+                    self.dropped += 1
+                elif not self.__on_loop():
+                    # stalling the network thread pushes back on the broker, when messages come
+                    # from the loop itself (i.e. the loopback transport) waiting would never end
+                    self.__not_full.wait_for(lambda: len(self.__pending) < self.__max_pending)
+            self.__pending.append((decoder, sink, Message(msg.topic, msg.payload)))
+            # only the first message into an idle ingestor needs to wake the loop
+            start_drain = not self.__draining
+            self.__draining = True
+        if start_drain:
+            self.__loop.call_soon_threadsafe(self.__start_drain)
+
+    def __on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+
+    def __start_drain(self):
+        self.__loop.create_task(self.__drain())
+
+    def __take_batch(self):
+        with self.__lock:
+            if len(self.__pending) == 0:
+                self.__draining = False
+                return None
+            batch = [self.__pending.popleft() for _ in range(min(self.__batch_size, len(self.__pending)))]
+            self.__not_full.notify_all()
+            return batch
+
+    async def __deliver(self, sink, result, msg: Message):
+        # sinks can be user callbacks, one that raises mustn't stop everything behind it being delivered
+        try:
+            # a sink that returns an awaitable wants to push back, i.e. a full queue
+            # with the BLOCK policy, so stop draining until it's done
+            outcome = sink(result)
+            if outcome is not None:
+                await outcome
+        except Exception as e:
+            self.sink_errors += 1
+            self.__logger.warning('failed to deliver message from %s: %s' % (msg.topic, repr(e)))
+
+    async def __drain(self):
+        try:
+            while True:
+                batch = self.__take_batch()
+                if batch is None:
+                    return
+                work = [(decoder, msg) for decoder, _, msg in batch]
+                if self.__executor is None:
+                    results = decode_batch(work)
+                else:
+                    results = await self.__loop.run_in_executor(self.__executor, decode_batch, work)
+                for (_, sink, msg), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        self.decode_errors += 1
+                        self.__logger.warning('failed to decode message on %s: %s' % (msg.topic, repr(result)))
+                    elif result is not None:
+                        await self.__deliver(sink, result, msg)
+        except asyncio.CancelledError:
+            # the loop is going away, whatever is pending stays there
+            with self.__lock:
+                self.__draining = False
+            raise
+        except Exception as e:
+            # i.e. the executor broke, the batch is lost but the next submit still has to
+            # be able to start another drain and anything already pending gets another go
+            self.__logger.warning('failed to drain: %s' % repr(e))
+            with self.__lock:
+                restart = len(self.__pending) > 0
+                self.__draining = restart
+            if restart:
+                self.__loop.call_soon(self.__start_drain)
+
+    def as_dict(self):
+        return {'received': self.received,
+                'pending': len(self.__pending),
+                'dropped': self.dropped,
+                'decode_errors': self.decode_errors,
+                'sink_errors': self.sink_errors}
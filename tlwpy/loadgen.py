@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import random
+from tlwpy.tlwbe import Tlwbe, RESULT_OK
+from tlwpy.gatewaysimulator import Gateway, Node
+from tlwpy.metrics import Histogram
+
+INTERVAL_FIXED = 'fixed'
+INTERVAL_POISSON = 'poisson'
+
+STAGE_PROVISION = 'provision'
+STAGE_JOIN = 'join'
+STAGE_UPLINK = 'uplink'
+
+
+class Report:
+    __slots__ = ['nodes', 'joined', 'join_failures', 'uplinks', 'uplink_failures', 'duration', 'latencies']
+
+    def __init__(self, nodes: int):
+        self.nodes = nodes
+        self.joined = 0
+        self.join_failures = 0
+        self.uplinks = 0
+        self.uplink_failures = 0
+        self.duration = 0.0
+        # a run is short lived and the report is about all of it so nothing gets windowed out
+        self.latencies = {STAGE_PROVISION: Histogram(window=None),
+                          STAGE_JOIN: Histogram(window=None),
+                          STAGE_UPLINK: Histogram(window=None)}
+
+    @property
+    def uplinks_per_second(self):
+        if self.duration == 0:
+            return 0.0
+        return self.uplinks / self.duration
+
+    @property
+    def join_success_rate(self):
+        attempts = self.joined + self.join_failures
+        if attempts == 0:
+            return 0.0
+        return self.joined / attempts
+
+    def merge(self, other):
+        # for reports from runs that happened side by side, so the durations overlap rather than add up
+        self.nodes += other.nodes
+        self.joined += other.joined
+        self.join_failures += other.join_failures
+        self.uplinks += other.uplinks
+        self.uplink_failures += other.uplink_failures
+        self.duration = max(self.duration, other.duration)
+        for stage, stats in other.latencies.items():
+            self.latencies[stage].merge(stats)
+
+    def as_dict(self):
+        return {'nodes': self.nodes,
+                'joined': self.joined,
+                'join_failures': self.join_failures,
+                'join_success_rate': self.join_success_rate,
+                'uplinks': self.uplinks,
+                'uplink_failures': self.uplink_failures,
+                'duration': self.duration,
+                'uplinks_per_second': self.uplinks_per_second,
+                'latencies': dict((stage, stats.as_dict()) for stage, stats in self.latencies.items())}
+
+
+class LoadGenerator:
+    __slots__ = ['__gateway', '__tlwbe', '__app_eui', '__num_nodes', '__uplink_rate', '__interval', '__port',
+                 '__payload_size', '__max_concurrent_joins', '__name_prefix', '__eui_base', '__logger', 'nodes',
+                 'report']
+
+    def __init__(self, gateway: Gateway, tlwbe: Tlwbe, app_eui: str, num_nodes: int, uplink_rate: float,
+                 interval: str = INTERVAL_FIXED, port: int = 1, payload_size: int = 8, max_concurrent_joins: int = 32,
+                 name_prefix: str = 'loadgen', eui_base: int = None):
+        assert len(app_eui) == 16
+        assert num_nodes > 0
+        assert uplink_rate > 0
+        assert interval in [INTERVAL_FIXED, INTERVAL_POISSON]
+        assert 1 <= port <= 223
+        self.__gateway = gateway
+        self.__tlwbe = tlwbe
+        self.__app_eui = app_eui
+        self.__num_nodes = num_nodes
+        self.__uplink_rate = uplink_rate
+        self.__interval = interval
+        self.__port = port
+        self.__payload_size = payload_size
+        self.__max_concurrent_joins = max_concurrent_joins
+        self.__name_prefix = name_prefix
+        self.__eui_base = eui_base if eui_base is not None else random.getrandbits(32) << 24
+        self.__logger = logging.getLogger('loadgen')
+        self.nodes = []
+        self.report = Report(num_nodes)
+
+    async def __provision_node(self, index: int, semaphore: asyncio.Semaphore):
+        dev_eui = '%016x' % ((self.__eui_base + index) & 0xffffffffffffffff)
+        key = os.urandom(16).hex()
+        name = '%s_%s' % (self.__name_prefix, dev_eui)
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            try:
+                result = await self.__tlwbe.add_dev(name, self.__app_eui, eui=dev_eui, key=key)
+            except asyncio.TimeoutError:
+                self.__logger.warning('timed out provisioning %s' % dev_eui)
+                return None
+            self.report.latencies[STAGE_PROVISION].observe(loop.time() - start)
+        if result.code != RESULT_OK:
+            self.__logger.warning('failed to provision %s, code %d' % (dev_eui, result.code))
+            return None
+        return Node(self.__gateway, self.__app_eui, dev_eui, key)
+
+    async def provision(self, max_in_flight: int = 32):
+        semaphore = asyncio.Semaphore(max_in_flight)
+        nodes = await asyncio.gather(*[self.__provision_node(i, semaphore) for i in range(self.__num_nodes)])
+        self.nodes = [node for node in nodes if node is not None]
+        self.__logger.info('provisioned %d of %d nodes' % (len(self.nodes), self.__num_nodes))
+        return self.nodes
+
+    async def deprovision(self):
+        await self.__tlwbe.delete_devs([node.dev_eui for node in self.nodes])
+        self.nodes = []
+
+    async def __join_node(self, node: Node, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            try:
+                await node.join()
+            except (asyncio.TimeoutError, AssertionError) as e:
+                self.__logger.warning('join failed for %s: %s' % (node.dev_eui, repr(e)))
+                self.report.join_failures += 1
+                return None
+            self.report.latencies[STAGE_JOIN].observe(loop.time() - start)
+            self.report.joined += 1
+            return node
+
+    async def join(self):
+        semaphore = asyncio.Semaphore(self.__max_concurrent_joins)
+        joined = await asyncio.gather(*[self.__join_node(node, semaphore) for node in self.nodes])
+        return [node for node in joined if node is not None]
+
+    def __next_delay(self, node_interval: float):
+        if self.__interval == INTERVAL_POISSON:
+            return random.expovariate(1 / node_interval)
+        return node_interval
+
+    async def __drive_node(self, node: Node, node_interval: float, end: float):
+        loop = asyncio.get_running_loop()
+        # spread the first uplinks across one interval so the nodes don't fire in lockstep
+        next_send = loop.time() + random.uniform(0, node_interval)
+        while True:
+            delay = min(next_send, end) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if loop.time() >= end:
+                break
+            payload = os.urandom(self.__payload_size) if self.__payload_size > 0 else None
+            start = loop.time()
+            try:
+                await node.send_uplink(self.__port, payload=payload)
+            except Exception as e:
+                self.__logger.warning('uplink failed for %s: %s' % (node.dev_eui, repr(e)))
+                self.report.uplink_failures += 1
+            else:
+                self.report.latencies[STAGE_UPLINK].observe(loop.time() - start)
+                self.report.uplinks += 1
+            # fixed intervals are scheduled from the previous slot so slow sends don't drift the rate
+            next_send += self.__next_delay(node_interval)
+
+    async def drive(self, nodes: list, duration: float):
+        if len(nodes) == 0:
+            return self.report
+        node_interval = len(nodes) / self.__uplink_rate
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        end = start + duration
+        await asyncio.gather(*[self.__drive_node(node, node_interval, end) for node in nodes])
+        self.report.duration += loop.time() - start
+        return self.report
+
+    async def run(self, duration: float):
+        if len(self.nodes) == 0:
+            await self.provision()
+        joined = await self.join()
+        return await self.drive(joined, duration)
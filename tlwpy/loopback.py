@@ -0,0 +1,370 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import struct
+import time
+import paho.mqtt.client as mqtt
+from mqttbase import MqttBase
+from tlwpy import lorawan
+
+
+def topic_matches(sub: str, topic: str):
+    sub_parts = sub.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(sub_parts):
+        if part == '#':
+            # topics starting with $ are only matched by filters that spell it out
+            return i > 0 or not topic.startswith('$')
+        if i >= len(topic_parts):
+            return False
+        if part == '+':
+            if i == 0 and topic.startswith('$'):
+                return False
+        elif part != topic_parts[i]:
+            return False
+    return len(sub_parts) == len(topic_parts)
+
+
+class LoopbackMessage:
+    __slots__ = ['topic', 'payload', 'qos', 'retain', 'mid']
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False, mid: int = 0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+
+
+class LoopbackMessageInfo:
+    __slots__ = ['mid', 'rc']
+
+    def __init__(self, mid: int):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+
+def _to_bytes(payload):
+    # the same conversions paho does
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+
+class LoopbackClient:
+    __slots__ = ['__broker', '__callbacks', '__mid', 'client_id', 'subscriptions', 'on_message', 'on_connect',
+                 'on_disconnect', 'on_subscribe', 'on_publish']
+
+    # the parts of paho's Client that the clients in here use, messages are delivered on the loop
+    def __init__(self, broker, client_id: str = ''):
+        self.__broker = broker
+        self.__callbacks = []
+        self.__mid = 0
+        self.client_id = client_id
+        self.subscriptions = set()
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.on_publish = None
+
+    def __next_mid(self):
+        self.__mid = (self.__mid % 0xffff) + 1
+        return self.__mid
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        mid = self.__next_mid()
+        self.__broker.publish(LoopbackMessage(topic, _to_bytes(payload), qos, retain, mid))
+        return LoopbackMessageInfo(mid)
+
+    def subscribe(self, topic, qos: int = 0):
+        topics = [topic] if isinstance(topic, str) else [t[0] if isinstance(t, tuple) else t for t in topic]
+        for t in topics:
+            self.subscriptions.add(t)
+        self.__broker.invalidate()
+        return mqtt.MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else topic
+        for t in topics:
+            self.subscriptions.discard(t)
+        self.__broker.invalidate()
+        return mqtt.MQTT_ERR_SUCCESS, self.__next_mid()
+
+    def message_callback_add(self, sub: str, callback):
+        self.message_callback_remove(sub)
+        self.__callbacks.append((sub, callback))
+
+    def message_callback_remove(self, sub: str):
+        self.__callbacks = [(s, c) for s, c in self.__callbacks if s != sub]
+
+    def deliver(self, msg: LoopbackMessage):
+        # like paho every matching callback gets the message and on_message only gets what's left
+        matched = False
+        for sub, callback in self.__callbacks:
+            if topic_matches(sub, msg.topic):
+                matched = True
+                callback(self, None, msg)
+        if not matched and self.on_message is not None:
+            self.on_message(self, None, msg)
+
+    def disconnect(self):
+        self.__broker.disconnect(self)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self, force=False):
+        pass
+
+
+class LoopbackBroker:
+    __slots__ = ['__clients', '__routes', '__bound', 'published', 'delivered']
+
+    def __init__(self):
+        self.__clients = []
+        # topic -> clients, subscriptions change rarely compared to publishes
+        self.__routes = {}
+        self.__bound = {}
+        self.published = 0
+        self.delivered = 0
+
+    def client(self, client_id: str = ''):
+        client = LoopbackClient(self, client_id)
+        self.__clients.append(client)
+        return client
+
+    def disconnect(self, client: LoopbackClient):
+        if client in self.__clients:
+            self.__clients.remove(client)
+            self.invalidate()
+
+    def invalidate(self):
+        self.__routes.clear()
+
+    def __route(self, topic: str):
+        clients = self.__routes.get(topic)
+        if clients is None:
+            clients = [client for client in self.__clients
+                       if any([topic_matches(sub, topic) for sub in client.subscriptions])]
+            self.__routes[topic] = clients
+        return clients
+
+    def publish(self, msg: LoopbackMessage):
+        self.published += 1
+        loop = asyncio.get_event_loop()
+        for client in self.__route(msg.topic):
+            self.delivered += 1
+            # never call back into the publisher, a real broker would always be a hop away
+            loop.call_soon(client.deliver, msg)
+
+    def bind(self, cls):
+        # cls must be an MqttBase subclass, this returns a version of it that talks to this broker
+        bound = self.__bound.get(cls)
+        if bound is None:
+            bound = type('Loopback%s' % cls.__name__, (cls, LoopbackBase), {'broker': self})
+            self.__bound[cls] = bound
+        return bound
+
+    def create(self, cls, *args, **kwargs):
+        return self.bind(cls)(*args, **kwargs)
+
+
+class LoopbackBase(MqttBase):
+    broker = None
+
+    # stands in for MqttBase's constructor when mixed in by LoopbackBroker.bind
+    def __init__(self, host: str = None, port: int = None, id: str = None, topics: list = None):
+        assert self.broker is not None, 'use LoopbackBroker.bind() to get a class that uses this'
+        self.event_loop = asyncio.get_event_loop()
+        self.mqtt_client = self.broker.client(id if id is not None else '')
+        if topics is not None:
+            for topic in topics:
+                self.mqtt_client.subscribe(topic)
+
+    async def wait_for_connection(self):
+        pass
+
+
+class StandInSession:
+    __slots__ = ['app_eui', 'dev_eui', 'devnonce', 'crypto', 'framecounter']
+
+    def __init__(self, app_eui: str, dev_eui: str, devnonce: int, crypto: lorawan.SessionCrypto):
+        self.app_eui = app_eui
+        self.dev_eui = dev_eui
+        self.devnonce = devnonce
+        self.crypto = crypto
+        # the full 32 bit counter of the last uplink, None until there's been one
+        self.framecounter = None
+
+
+class TlwbeStandIn:
+    __slots__ = ['__client', '__logger', '__sessions', '__devaddrs', '__next_devaddr', 'devs', 'apps', 'requests',
+                 'netid', 'joins', 'uplinks', 'stored_uplinks']
+
+    # answers tlwbe control requests from memory so Tlwbe can be exercised without the real backend,
+    # client can come from LoopbackBroker.client() or be a connected paho client. it also plays the
+    # network server for the devices that were added, answering joins on the gateway's tx topic
+    # and passing their uplinks on like tlwbe would
+    def __init__(self, client, netid: int = 0x13, devaddr_base: int = 0x26000000):
+        self.__client = client
+        self.__logger = logging.getLogger('tlwbe_standin')
+        # devaddr -> StandInSession
+        self.__sessions = {}
+        # dev eui -> devaddr of its current session
+        self.__devaddrs = {}
+        self.__next_devaddr = devaddr_base
+        self.devs = {}
+        self.apps = {}
+        self.requests = 0
+        self.netid = netid
+        self.joins = 0
+        self.uplinks = 0
+        # what the uplink queries are answered from, in the order they arrived
+        self.stored_uplinks = []
+        self.__client.subscribe('tlwbe/control/+/+/+')
+        self.__client.subscribe('tlwbe/uplinks/query/+')
+        self.__client.subscribe('tlwbe/downlink/query/+')
+        self.__client.subscribe('tlwbe/downlink/schedule/#')
+        self.__client.message_callback_add('tlwbe/control/+/+/+', self.__on_control)
+        self.__client.message_callback_add('tlwbe/uplinks/query/+', self.__on_uplinks_query)
+        self.__client.message_callback_add('tlwbe/downlink/query/+', self.__on_downlink_query)
+        self.__client.message_callback_add('tlwbe/downlink/schedule/#', self.__on_downlink_schedule)
+        self.__client.subscribe('pktfwdbr/+/rx/#')
+        self.__client.message_callback_add('pktfwdbr/+/rx/#', self.__on_rx)
+
+    def __reply(self, kind: str, token: str, result: dict):
+        self.requests += 1
+        self.__client.publish('tlwbe/%s/result/%s' % (kind, token), json.dumps(result))
+
+    def __control(self, what: str, action: str, request: dict):
+        things = self.devs if what == 'dev' else self.apps
+        if action == 'list':
+            return {'code': 0, 'eui_list': list(things.keys())}
+        if action == 'add':
+            thing = {'name': request['name'], 'eui': request.get('eui', os.urandom(8).hex()).lower()}
+            if what == 'dev':
+                thing['appeui'] = request['appeui']
+                thing['key'] = request.get('key', os.urandom(16).hex())
+                thing['serial'] = 0
+            things[thing['eui']] = thing
+            return {'code': 0, what: thing}
+        thing = things.get(request.get('eui'))
+        if thing is None and action == 'get':
+            for candidate in things.values():
+                if candidate['name'] == request.get('name'):
+                    thing = candidate
+                    break
+        if thing is None:
+            return {'code': 1}
+        if action == 'del':
+            things.pop(thing['eui'])
+        elif action == 'update':
+            thing['name'] = request.get('name', thing['name'])
+        return {'code': 0, what: thing}
+
+    def __on_control(self, client, userdata, msg):
+        parts = msg.topic.split('/')
+        what, action, token = parts[2], parts[3], parts[4]
+        self.__reply('control', token, self.__control(what, action, json.loads(msg.payload)))
+
+    def __query_uplinks(self, query: dict):
+        uplinks = [uplink for uplink in self.stored_uplinks
+                   if query.get('appeui', uplink['appeui']) == uplink['appeui']
+                   and query.get('deveui', uplink['deveui']) == uplink['deveui']
+                   and uplink['timestamp'] >= query.get('since', 0)]
+        offset = query.get('offset', 0)
+        limit = query.get('limit')
+        return uplinks[offset:offset + limit if limit is not None else None]
+
+    def __on_uplinks_query(self, client, userdata, msg):
+        uplinks = self.__query_uplinks(json.loads(msg.payload))
+        self.__reply('uplinks', msg.topic.split('/')[-1], {'code': 0, 'uplinks': uplinks})
+
+    def __on_downlink_query(self, client, userdata, msg):
+        self.__reply('downlink', msg.topic.split('/')[-1], {'code': 0, 'downlinks': []})
+
+    def __on_downlink_schedule(self, client, userdata, msg):
+        self.__reply('downlink', msg.topic.split('/')[-1], {'code': 0})
+
+    def __on_rx(self, client, userdata, msg):
+        # pktfwdbr/<gateway>/rx/<type>/..., joins have the app and dev euis on the end
+        parts = msg.topic.split('/')
+        rxpk = json.loads(msg.payload)
+        data = base64.b64decode(rxpk['data'])
+        pkt_type = lorawan.get_packet_type(data)
+        if pkt_type == lorawan.MHDR_MTYPE_JOINREQ and len(parts) >= 6:
+            self.__on_joinreq(parts[1], parts[4].lower(), parts[5].lower(), data)
+        elif pkt_type == lorawan.MHDR_MTYPE_UNCNFUP or pkt_type == lorawan.MHDR_MTYPE_CNFUP:
+            self.__on_uplink(lorawan.Uplink(data), rxpk)
+
+    def __on_joinreq(self, gateway: str, app_eui: str, dev_eui: str, data: bytes):
+        dev = self.devs.get(dev_eui)
+        if dev is None or dev['appeui'].lower() != app_eui:
+            self.__logger.debug('join from unknown device %s' % dev_eui)
+            return
+        key = bytes.fromhex(dev['key'])
+        if lorawan.calculate_mic(key, data[:-4]) != struct.unpack_from('<L', data, len(data) - 4)[0]:
+            self.__logger.warning('bad mic on join from %s' % dev_eui)
+            return
+        devnonce = lorawan.JoinReq(data).devnonce
+        # every gateway that heard the join passes it on, only the first copy gets an answer
+        current = self.__sessions.get(self.__devaddrs.get(dev_eui))
+        if current is not None and current.devnonce == devnonce:
+            return
+        if current is not None:
+            self.__sessions.pop(self.__devaddrs[dev_eui])
+
+        devaddr = self.__next_devaddr
+        self.__next_devaddr += 1
+        appnonce = random.getrandbits(24)
+        crypto = lorawan.SessionKeys(key, appnonce, self.netid, devnonce).crypto
+        self.__sessions[devaddr] = StandInSession(app_eui, dev_eui, devnonce, crypto)
+        self.__devaddrs[dev_eui] = devaddr
+        self.joins += 1
+
+        joinaccept = lorawan.build_joinaccept(key, appnonce, self.netid, devaddr)
+        self.__client.publish('pktfwdbr/%s/tx/%s' % (gateway, os.urandom(4).hex()),
+                              json.dumps({'txpk': {'data': base64.b64encode(joinaccept).decode('ascii')}}))
+        self.__client.publish('tlwbe/join/%s/%s' % (app_eui, dev_eui),
+                              json.dumps({'timestamp': int(time.time() * 1000000)}))
+
+    def __on_uplink(self, uplink: lorawan.Uplink, rxpk: dict):
+        session = self.__sessions.get(uplink.devaddr)
+        if session is None:
+            return
+        last = session.framecounter
+        framecounter = uplink.full_framecounter(last if last is not None else 0)
+        # copies from the other gateways in a cluster
+        if last is not None and framecounter <= last:
+            return
+        if not uplink.verify_mic(session.crypto, framecounter):
+            self.__logger.warning('bad mic on uplink from %s' % session.dev_eui)
+            return
+        session.framecounter = framecounter
+        self.uplinks += 1
+        payload = uplink.decrypt(session.crypto, framecounter)
+        uplink_json = {'timestamp': int(time.time() * 1000000),
+                       'appeui': session.app_eui,
+                       'deveui': session.dev_eui,
+                       'port': uplink.port,
+                       'payload': base64.b64encode(payload).decode('ascii'),
+                       'rfparams': dict((k, rxpk.get(k)) for k in ['freq', 'datr', 'rssi', 'lsnr'])}
+        self.stored_uplinks.append(uplink_json)
+        self.__client.publish('tlwbe/uplink/%s/%s/%d' % (session.app_eui, session.dev_eui, uplink.port),
+                              json.dumps(uplink_json))
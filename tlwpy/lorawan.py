@@ -1,8 +1,10 @@
 import struct
-import logging
 from enum import IntEnum
+from functools import lru_cache
 
-from tlwpy.liblorawan import decrypt_joinack, calculate_mic, calculate_sessionkeys
+from tlwpy.liblorawan import decrypt_joinack, calculate_mic, calculate_sessionkeys, build_data
+from tlwpy import maccommands
+from tlwpy.maccommands import DIRECTION_UP, DIRECTION_DOWN
 
 MHDR_MTYPE_SHIFT = 5
 MHDR_MTYPE_MASK = 0b111
@@ -15,6 +17,11 @@ MHDR_MTYPE_CNFDN = 0b101
 
 FCTRL_FOPTSLEN_MASK = 0b1111
 
+AES_BLOCK_SIZE = 16
+
+FCNT16_MASK = 0xffff
+FCNT32_MASK = 0xffffffff
+
 
 def get_packet_type(raw_packet: bytearray):
     mhdr = raw_packet[0]
@@ -31,11 +38,21 @@ class PacketType(IntEnum):
 
 
 class Packet:
-    __slots__ = ['type', 'mac_payload']
+    __slots__ = ['type', 'raw']
 
     def __init__(self, raw_packet: bytearray):
-        self.type = get_packet_type(raw_packet)
-        self.mac_payload = raw_packet[1:-4]
+        # everything else is a view into this, nothing is copied out of the frame unless asked for
+        self.raw = memoryview(raw_packet)
+        self.type = get_packet_type(self.raw)
+
+    def __reduce__(self):
+        # memoryviews can't be pickled, rebuilding from the frame keeps decoded packets
+        # able to come back from a process pool
+        return self.__class__, (bytes(self.raw),)
+
+    @property
+    def mac_payload(self):
+        return self.raw[1:-4]
 
 
 class JoinReq(Packet):
@@ -43,10 +60,7 @@ class JoinReq(Packet):
 
     def __init__(self, raw_packet: bytearray):
         super(JoinReq, self).__init__(raw_packet)
-        unpacked = struct.unpack('<QQH', self.mac_payload)
-        self.appeui = unpacked[0]
-        self.deveui = unpacked[1]
-        self.devnonce = unpacked[2]
+        self.appeui, self.deveui, self.devnonce = struct.unpack_from('<QQH', self.raw, 1)
 
 
 class JoinAccept(Packet):
@@ -55,15 +69,154 @@ class JoinAccept(Packet):
     def __init__(self, raw_packet: bytearray):
         super(JoinAccept, self).__init__(raw_packet)
 
-        fixed_part = self.mac_payload[:12]
-        fixed_part[3:3] = [0]
-        fixed_part[7:7] = [0]
-        unpacked = struct.unpack('<LLLBB', fixed_part)
-        self.appnonce = unpacked[0]
-        self.netid = unpacked[1]
-        self.devaddr = unpacked[2]
-        self.dlsetting = unpacked[3]
-        self.rxdelay = unpacked[4]
+        # appnonce and netid are 24 bits so they come out in two pieces
+        unpacked = struct.unpack_from('<HBHBLBB', self.raw, 1)
+        self.appnonce = unpacked[0] | (unpacked[1] << 16)
+        self.netid = unpacked[2] | (unpacked[3] << 16)
+        self.devaddr = unpacked[4]
+        self.dlsetting = unpacked[5]
+        self.rxdelay = unpacked[6]
+
+
+def reconstruct_framecounter(framecounter16: int, last_framecounter: int):
+    # only the bottom 16 bits go over the air, if they've gone backwards the counter wrapped
+    framecounter = (last_framecounter & ~FCNT16_MASK & FCNT32_MASK) | (framecounter16 & FCNT16_MASK)
+    if framecounter < last_framecounter:
+        framecounter += FCNT16_MASK + 1
+    return framecounter & FCNT32_MASK
+
+
+def calculate_data_mic(network_key: bytes, devaddr: int, framecounter: int, direction: int, data: bytes):
+    b0 = struct.pack('<BLBLLBB', 0x49, 0, direction, devaddr, framecounter & FCNT32_MASK, 0, len(data))
+    return calculate_mic(network_key, b0 + data)
+
+
+def aes_encrypt_blocks(key: bytes, blocks: bytes):
+    # devices "decrypt" a join accept with an AES encrypt so decrypt_joinack is really
+    # AES-128-ECB encrypt over whole blocks, the leading byte just stands in for the MHDR
+    assert len(blocks) % AES_BLOCK_SIZE == 0
+    return decrypt_joinack(key, bytes([MHDR_MTYPE_JOINACK << MHDR_MTYPE_SHIFT]) + blocks)[1:]
+
+
+def _xtime(a: int):
+    a <<= 1
+    return a ^ 0x11b if a & 0x100 else a
+
+
+def _gf_mul(a: int, b: int):
+    product = 0
+    while b != 0:
+        if b & 1:
+            product ^= a
+        a = _xtime(a)
+        b >>= 1
+    return product
+
+
+@lru_cache(maxsize=1)
+def _aes_inverse_tables():
+    # walks the field with generator 3 and its inverse at the same time, see FIPS-197 5.1.1
+    sbox = [0x63] * 256
+    p = q = 1
+    while True:
+        p = p ^ _xtime(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        rotated = [((q << n) | (q >> (8 - n))) & 0xff for n in range(1, 5)]
+        sbox[p] = q ^ rotated[0] ^ rotated[1] ^ rotated[2] ^ rotated[3] ^ 0x63
+        if p == 1:
+            break
+    inverse = [0] * 256
+    for x, y in enumerate(sbox):
+        inverse[y] = x
+    return sbox, inverse
+
+
+def _aes_round_keys(key: bytes):
+    sbox, _ = _aes_inverse_tables()
+    words = [list(key[i:i + 4]) for i in range(0, 16, 4)]
+    rcon = 1
+    for i in range(4, 44):
+        word = list(words[i - 1])
+        if i % 4 == 0:
+            word = [sbox[b] for b in word[1:] + word[:1]]
+            word[0] ^= rcon
+            rcon = _xtime(rcon)
+        words.append([a ^ b for a, b in zip(word, words[i - 4])])
+    return [sum(words[r * 4:(r + 1) * 4], []) for r in range(11)]
+
+
+def _aes_decrypt_block(round_keys: list, block: bytes):
+    _, inverse = _aes_inverse_tables()
+    state = [a ^ b for a, b in zip(block, round_keys[10])]
+    for r in range(9, -1, -1):
+        # inverse shift rows then sub bytes, the state is column major
+        state = [inverse[state[(i - 4 * (i % 4)) % 16]] for i in range(16)]
+        state = [a ^ b for a, b in zip(state, round_keys[r])]
+        if r == 0:
+            break
+        mixed = []
+        for c in range(0, 16, 4):
+            a0, a1, a2, a3 = state[c:c + 4]
+            mixed += [_gf_mul(a0, 14) ^ _gf_mul(a1, 11) ^ _gf_mul(a2, 13) ^ _gf_mul(a3, 9),
+                      _gf_mul(a0, 9) ^ _gf_mul(a1, 14) ^ _gf_mul(a2, 11) ^ _gf_mul(a3, 13),
+                      _gf_mul(a0, 13) ^ _gf_mul(a1, 9) ^ _gf_mul(a2, 14) ^ _gf_mul(a3, 11),
+                      _gf_mul(a0, 11) ^ _gf_mul(a1, 13) ^ _gf_mul(a2, 9) ^ _gf_mul(a3, 14)]
+        state = mixed
+    return bytes(state)
+
+
+def aes_decrypt_blocks(key: bytes, blocks: bytes):
+    # the inverse of aes_encrypt_blocks, liblorawan only has the device side of the join so this
+    # is plain python. it's only for stand-ins and tests that need to build join accepts
+    assert len(blocks) % AES_BLOCK_SIZE == 0
+    round_keys = _aes_round_keys(bytes(key))
+    return b''.join([_aes_decrypt_block(round_keys, blocks[i:i + AES_BLOCK_SIZE])
+                     for i in range(0, len(blocks), AES_BLOCK_SIZE)])
+
+
+def build_joinaccept(key: bytes, appnonce: int, netid: int, devaddr: int, dlsettings: int = 0, rxdelay: int = 1):
+    # what a network server sends back, the payload is AES decrypted so the device can use an encrypt
+    msg = struct.pack('<BHBHBLBB', MHDR_MTYPE_JOINACK << MHDR_MTYPE_SHIFT, appnonce & 0xffff, appnonce >> 16,
+                      netid & 0xffff, netid >> 16, devaddr, dlsettings, rxdelay)
+    msg += struct.pack('<L', calculate_mic(key, msg))
+    return msg[:1] + aes_decrypt_blocks(key, msg[1:])
+
+
+class SessionCrypto:
+    __slots__ = ['network_key', 'app_key']
+
+    def __init__(self, network_key: bytes, app_key: bytes):
+        assert len(network_key) == 16
+        assert len(app_key) == 16
+        self.network_key = bytes(network_key)
+        self.app_key = bytes(app_key)
+
+    def calculate_mic(self, data: bytes):
+        return calculate_mic(self.network_key, data)
+
+    def calculate_data_mic(self, devaddr: int, framecounter: int, direction: int, data: bytes):
+        return calculate_data_mic(self.network_key, devaddr, framecounter, direction, data)
+
+    def build_data(self, packet_type: PacketType, devaddr: int, framecounter: int, port: int, payload: bytes = None):
+        return build_data(int(packet_type), devaddr, framecounter, port, payload, self.network_key, self.app_key)
+
+    def crypt_frmpayload(self, port: int, devaddr: int, framecounter: int, direction: int, payload: bytes):
+        # FRMPayload is AES-CTR'd so this both encrypts and decrypts
+        if len(payload) == 0:
+            return b''
+        key = self.network_key if port == 0 else self.app_key
+        num_blocks = (len(payload) + AES_BLOCK_SIZE - 1) // AES_BLOCK_SIZE
+        framecounter &= FCNT32_MASK
+        counter_blocks = b''.join([struct.pack('<BLBLLBB', 0x01, 0, direction, devaddr, framecounter, 0, i)
+                                   for i in range(1, num_blocks + 1)])
+        keystream = aes_encrypt_blocks(key, counter_blocks)
+        crypted = int.from_bytes(payload, 'little') ^ int.from_bytes(keystream[:len(payload)], 'little')
+        return crypted.to_bytes(len(payload), 'little')
 
 
 class SessionKeys:
@@ -71,10 +224,15 @@ class SessionKeys:
 
     def __init__(self, key: bytes, appnonce: int, netid: int, devnonce: int):
         keys = calculate_sessionkeys(key, appnonce, netid, devnonce)
-        assert len(keys) is 32
+        assert len(keys) == 32
         self.network_key = keys[:16]
         self.app_key = keys[16:]
 
+    @property
+    def crypto(self):
+        # whatever holds on to the session should keep this rather than asking for it per frame
+        return SessionCrypto(self.network_key, self.app_key)
+
     def from_join_req_and_accept(self, key: bytes, req: JoinReq, accept: JoinAccept):
         return SessionKeys(key, accept.appnonce, accept.netid, req.devnonce)
 
@@ -86,75 +244,136 @@ class EncryptedJoinAccept:
         assert (len(data) - 1) % 16 == 0
         self.data = data
 
-    def decrypt(self, key: bytes):
+    def __decrypt(self, key: bytes):
         decrypted = decrypt_joinack(key, self.data)
         assert (len(decrypted) - 1) % 16 == 0
         packet_mic = struct.unpack('<L', decrypted[-4:])[0]
         actual_mic = calculate_mic(key, bytes(decrypted[:-4]))
+        return decrypted, packet_mic, actual_mic
+
+    def decrypt(self, key: bytes):
+        decrypted, packet_mic, actual_mic = self.__decrypt(key)
         assert packet_mic == actual_mic, ('Calculated mic of %x but expected %x' % (actual_mic, packet_mic))
         return JoinAccept(decrypted)
 
+    def try_decrypt(self, key: bytes):
+        decrypted, packet_mic, actual_mic = self.__decrypt(key)
+        if packet_mic != actual_mic:
+            return None
+        return JoinAccept(decrypted)
+
 
 class Data(Packet):
     __slots__ = ['devaddr',
-                 'adr',
-                 'ack',
                  'framecounter',
-                 'port',
-                 'data',
-                 'mic',
                  'fctrl',
-                 '__micced_part']
+                 '__port',
+                 '__frmpayload']
 
     FCTRL_ADR_SHIFT = 7
     FCTRL_ACK_SHIFT = 5
 
-    def __init__(self, raw_packet: bytearray):
-        super(Data, self).__init__(raw_packet)
-
-        self.__micced_part = raw_packet[:-4]
+    DIRECTION = DIRECTION_UP
 
-        self.mic = raw_packet[-4:]
+    FHDR_OFFSET = 1
+    FOPTS_OFFSET = 8
 
-        # unpack the header and get the devaddr and framecounter
-        fheader = self.mac_payload[0:7]
-        unpacked_header = struct.unpack('<IBh', fheader)
-        self.devaddr = unpacked_header[0]
-        self.framecounter = unpacked_header[2]
+    def __init__(self, raw_packet: bytearray):
+        super(Data, self).__init__(raw_packet)
 
-        # parse fctrl byte
-        self.fctrl = unpacked_header[1]
-        self.adr = bool(self.fctrl >> self.FCTRL_ADR_SHIFT)
-        self.ack = bool(self.fctrl >> self.FCTRL_ACK_SHIFT)
-        num_fopts = self.fctrl & FCTRL_FOPTSLEN_MASK
-        logging.debug('packet has %d fopts' % num_fopts)
+        # the header is all that's needed to route a frame, the rest is decoded on demand
+        # framecounter is only the bottom 16 bits of the session's counter, see full_framecounter()
+        self.devaddr, self.fctrl, self.framecounter = struct.unpack_from('<IBH', self.raw, self.FHDR_OFFSET)
 
-        # pull out the port and payload
-        frmpayload = self.mac_payload[7 + num_fopts:]
+    def __decode_payload(self):
+        frmpayload = self.raw[self.FOPTS_OFFSET + self.num_fopts:-4]
         if len(frmpayload) != 0:
-            self.port = struct.unpack('<B', frmpayload[0:1])[0]
+            self.__port = frmpayload[0]
+            self.__frmpayload = frmpayload[1:]
         else:
-            logging.debug('packet has no payload')
-            self.port = 0
-
-    def verify_mic(self, key: bytes):
-        return calculate_mic(key, self.__micced_part) == self.mic
-
-    def decrypt(self):
-        pass
+            self.__port = 0
+            self.__frmpayload = frmpayload
+
+    @property
+    def adr(self):
+        return bool((self.fctrl >> self.FCTRL_ADR_SHIFT) & 1)
+
+    @property
+    def ack(self):
+        return bool((self.fctrl >> self.FCTRL_ACK_SHIFT) & 1)
+
+    @property
+    def num_fopts(self):
+        return self.fctrl & FCTRL_FOPTSLEN_MASK
+
+    @property
+    def fopts(self):
+        return self.raw[self.FOPTS_OFFSET:self.FOPTS_OFFSET + self.num_fopts]
+
+    @property
+    def port(self):
+        try:
+            return self.__port
+        except AttributeError:
+            self.__decode_payload()
+            return self.__port
+
+    @property
+    def frmpayload(self):
+        try:
+            return self.__frmpayload
+        except AttributeError:
+            self.__decode_payload()
+            return self.__frmpayload
+
+    @property
+    def mic(self):
+        return self.raw[-4:]
+
+    def full_framecounter(self, last_framecounter: int):
+        return reconstruct_framecounter(self.framecounter, last_framecounter)
+
+    def verify_mic(self, key, framecounter: int = None):
+        # the mic covers the full 32 bit counter so for sessions past 0xffff frames
+        # the caller needs to pass in the reconstructed counter
+        if framecounter is None:
+            framecounter = self.framecounter
+        # key can be the raw network key or the SessionCrypto for the session
+        network_key = key.network_key if isinstance(key, SessionCrypto) else key
+        actual_mic = calculate_data_mic(network_key, self.devaddr, framecounter, self.DIRECTION, bytes(self.raw[:-4]))
+        return actual_mic == struct.unpack_from('<L', self.raw, len(self.raw) - 4)[0]
+
+    def decrypt(self, crypto: SessionCrypto, framecounter: int = None):
+        if framecounter is None:
+            framecounter = self.framecounter
+        return crypto.crypt_frmpayload(self.port, self.devaddr, framecounter, self.DIRECTION, bytes(self.frmpayload))
+
+    def mac_commands(self, crypto: SessionCrypto = None, framecounter: int = None):
+        commands = maccommands.parse(self.fopts, self.DIRECTION)
+        # port 0 frames carry mac commands in the payload instead, encrypted with the network key
+        if self.port == 0 and len(self.frmpayload) != 0:
+            assert crypto is not None, 'need the session keys to decode mac commands in the payload'
+            commands += maccommands.parse(self.decrypt(crypto, framecounter), self.DIRECTION)
+        return commands
 
 
 class Uplink(Data):
+    __slots__ = []
 
     def __init__(self, raw_packet: bytearray):
         super(Uplink, self).__init__(raw_packet)
 
 
 class Downlink(Data):
-    __slots__ = ['fpending']
+    __slots__ = []
 
     FCTRL_FPENDING_SHIFT = 4
 
+    DIRECTION = DIRECTION_DOWN
+
     def __init__(self, raw_packet: bytearray):
         super(Downlink, self).__init__(raw_packet)
-        self.fpending = bool(self.fctrl >> self.FCTRL_FPENDING_SHIFT)
+
+    @property
+    def fpending(self):
+        return bool((self.fctrl >> self.FCTRL_FPENDING_SHIFT) & 1)
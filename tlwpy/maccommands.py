@@ -0,0 +1,150 @@
+import struct
+
+DIRECTION_UP = 0
+DIRECTION_DOWN = 1
+
+
+class MacCommandException(Exception):
+    pass
+
+
+def _link_check_ans(payload):
+    margin, gw_cnt = struct.unpack('<BB', payload)
+    return {'margin': margin, 'gw_cnt': gw_cnt}
+
+
+def _link_adr_req(payload):
+    dr_txpower, chmask, redundancy = struct.unpack('<BHB', payload)
+    return {'datarate': dr_txpower >> 4, 'txpower': dr_txpower & 0xf, 'chmask': chmask,
+            'chmaskcntl': (redundancy >> 4) & 0x7, 'nbtrans': redundancy & 0xf}
+
+
+def _link_adr_ans(payload):
+    status = payload[0]
+    return {'power_ack': bool(status & 0b100), 'datarate_ack': bool(status & 0b010),
+            'chmask_ack': bool(status & 0b001)}
+
+
+def _duty_cycle_req(payload):
+    return {'maxdcycle': payload[0] & 0xf}
+
+
+def _rx_param_setup_req(payload):
+    dlsettings = payload[0]
+    return {'rx1droffset': (dlsettings >> 4) & 0x7, 'rx2datarate': dlsettings & 0xf,
+            'frequency': int.from_bytes(payload[1:4], 'little') * 100}
+
+
+def _rx_param_setup_ans(payload):
+    status = payload[0]
+    return {'rx1droffset_ack': bool(status & 0b100), 'rx2datarate_ack': bool(status & 0b010),
+            'channel_ack': bool(status & 0b001)}
+
+
+def _dev_status_ans(payload):
+    battery, margin = struct.unpack('<Bb', payload)
+    # margin is a signed 6 bit value
+    margin = ((margin & 0x3f) ^ 0x20) - 0x20
+    return {'battery': battery, 'margin': margin}
+
+
+def _new_channel_req(payload):
+    return {'chindex': payload[0], 'frequency': int.from_bytes(payload[1:4], 'little') * 100,
+            'maxdr': payload[4] >> 4, 'mindr': payload[4] & 0xf}
+
+
+def _new_channel_ans(payload):
+    status = payload[0]
+    return {'datarate_ok': bool(status & 0b10), 'channel_frequency_ok': bool(status & 0b01)}
+
+
+def _rx_timing_setup_req(payload):
+    return {'delay': payload[0] & 0xf}
+
+
+def _tx_param_setup_req(payload):
+    params = payload[0]
+    return {'downlink_dwell_time': bool(params & 0b100000), 'uplink_dwell_time': bool(params & 0b10000),
+            'maxeirp': params & 0xf}
+
+
+def _dl_channel_req(payload):
+    return {'chindex': payload[0], 'frequency': int.from_bytes(payload[1:4], 'little') * 100}
+
+
+def _dl_channel_ans(payload):
+    status = payload[0]
+    return {'uplink_frequency_exists': bool(status & 0b10), 'channel_frequency_ok': bool(status & 0b01)}
+
+
+def _device_time_ans(payload):
+    seconds, fraction = struct.unpack('<LB', payload)
+    return {'seconds': seconds, 'fraction': fraction}
+
+
+# cid -> (name, payload length, decoder)
+UPLINK_COMMANDS = {
+    0x02: ('LinkCheckReq', 0, None),
+    0x03: ('LinkADRAns', 1, _link_adr_ans),
+    0x04: ('DutyCycleAns', 0, None),
+    0x05: ('RXParamSetupAns', 1, _rx_param_setup_ans),
+    0x06: ('DevStatusAns', 2, _dev_status_ans),
+    0x07: ('NewChannelAns', 1, _new_channel_ans),
+    0x08: ('RXTimingSetupAns', 0, None),
+    0x09: ('TxParamSetupAns', 0, None),
+    0x0a: ('DlChannelAns', 1, _dl_channel_ans),
+    0x0d: ('DeviceTimeReq', 0, None)
+}
+
+DOWNLINK_COMMANDS = {
+    0x02: ('LinkCheckAns', 2, _link_check_ans),
+    0x03: ('LinkADRReq', 4, _link_adr_req),
+    0x04: ('DutyCycleReq', 1, _duty_cycle_req),
+    0x05: ('RXParamSetupReq', 4, _rx_param_setup_req),
+    0x06: ('DevStatusReq', 0, None),
+    0x07: ('NewChannelReq', 5, _new_channel_req),
+    0x08: ('RXTimingSetupReq', 1, _rx_timing_setup_req),
+    0x09: ('TxParamSetupReq', 1, _tx_param_setup_req),
+    0x0a: ('DlChannelReq', 4, _dl_channel_req),
+    0x0d: ('DeviceTimeAns', 5, _device_time_ans)
+}
+
+
+class MacCommand:
+    __slots__ = ['cid', 'name', 'payload', '__decoder', '__fields']
+
+    def __init__(self, cid: int, name: str, payload: bytes, decoder=None):
+        self.cid = cid
+        self.name = name
+        self.payload = payload
+        self.__decoder = decoder
+        self.__fields = None
+
+    @property
+    def fields(self):
+        if self.__fields is None:
+            self.__fields = self.__decoder(self.payload) if self.__decoder is not None else {}
+        return self.__fields
+
+    def __repr__(self):
+        return '%s(%s)' % (self.name, self.payload.hex())
+
+
+def parse(data: bytes, direction: int):
+    commands = UPLINK_COMMANDS if direction == DIRECTION_UP else DOWNLINK_COMMANDS
+    data = bytes(data)
+    parsed = []
+    offset = 0
+    while offset < len(data):
+        cid = data[offset]
+        command = commands.get(cid)
+        # the length of a command is implied by its cid so nothing after an unknown one can be parsed
+        if command is None:
+            raise MacCommandException('unknown mac command 0x%02x at offset %d' % (cid, offset))
+        name, length, decoder = command
+        start = offset + 1
+        offset = start + length
+        if offset > len(data):
+            raise MacCommandException('%s is truncated' % name)
+        parsed.append(MacCommand(cid, name, data[start:offset], decoder))
+    return parsed
@@ -0,0 +1,161 @@
+import collections
+import math
+
+DEFAULT_WINDOW = 1024
+
+PERCENTILES = [50, 95, 99]
+
+
+def _percentile(ordered: list, pct: float):
+    index = max(0, math.ceil((pct / 100) * len(ordered)) - 1)
+    return ordered[index]
+
+
+class Histogram:
+    __slots__ = ['__samples', 'count', 'sum']
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        # percentiles are over the last window samples so they follow the current
+        # behaviour rather than everything since startup, None keeps every sample
+        self.__samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.__samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.__samples.extend(other.samples)
+        self.count += other.count
+        self.sum += other.sum
+
+    @property
+    def samples(self):
+        return list(self.__samples)
+
+    def __len__(self):
+        return len(self.__samples)
+
+    def percentile(self, pct: float):
+        if len(self.__samples) == 0:
+            return None
+        return _percentile(sorted(self.__samples), pct)
+
+    def as_dict(self):
+        if len(self.__samples) == 0:
+            return {'count': self.count}
+        ordered = sorted(self.__samples)
+        summary = {'count': self.count,
+                   'sum': self.sum,
+                   'min': ordered[0],
+                   'max': ordered[-1],
+                   'mean': sum(ordered) / len(ordered)}
+        for pct in PERCENTILES:
+            summary['p%d' % pct] = _percentile(ordered, pct)
+        return summary
+
+
+class Counter:
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def merge(self, other):
+        self.value += other.value
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+class Gauge:
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def dec(self, amount: int = 1):
+        self.value -= amount
+
+    def merge(self, other):
+        self.value += other.value
+
+    def as_dict(self):
+        return {'value': self.value}
+
+
+def _format_labels(labels: tuple, extra: tuple = ()):
+    labels = labels + extra
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (key, value) for key, value in labels])
+
+
+class Registry:
+    __slots__ = ['__metrics']
+
+    def __init__(self):
+        # (name, sorted label items) -> metric
+        self.__metrics = collections.OrderedDict()
+
+    def __get(self, cls, name: str, labels: dict, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            metric = cls(*args)
+            self.__metrics[key] = metric
+        assert isinstance(metric, cls), '%s is already a %s' % (name, type(metric).__name__)
+        return metric
+
+    def histogram(self, name: str, window: int = DEFAULT_WINDOW, **labels):
+        return self.__get(Histogram, name, labels, window)
+
+    def counter(self, name: str, **labels):
+        return self.__get(Counter, name, labels)
+
+    def gauge(self, name: str, **labels):
+        return self.__get(Gauge, name, labels)
+
+    def merge(self, other):
+        # for combining registries from several simulators into one view
+        for (name, labels), metric in other.items():
+            self.__get(type(metric), name, dict(labels)).merge(metric)
+
+    def items(self):
+        return list(self.__metrics.items())
+
+    def as_dict(self):
+        return dict(('%s%s' % (name, _format_labels(labels)), metric.as_dict())
+                    for (name, labels), metric in self.__metrics.items())
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+        # every series of a metric has to be together, sorting is stable so they keep their order
+        for (name, labels), metric in sorted(self.__metrics.items(), key=lambda item: item[0][0]):
+            if isinstance(metric, Histogram):
+                if name not in typed:
+                    lines.append('# TYPE %s summary' % name)
+                for pct in PERCENTILES:
+                    value = metric.percentile(pct)
+                    lines.append('%s%s %s' % (name, _format_labels(labels, (('quantile', '%g' % (pct / 100)),)),
+                                              'NaN' if value is None else repr(value)))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels), metric.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), metric.count))
+            else:
+                if name not in typed:
+                    lines.append('# TYPE %s %s' % (name, 'counter' if isinstance(metric, Counter) else 'gauge'))
+                lines.append('%s%s %r' % (name, _format_labels(labels), metric.value))
+            typed.add(name)
+        return '\n'.join(lines) + '\n'
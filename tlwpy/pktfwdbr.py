@@ -4,55 +4,152 @@ import base64
 from tlwpy import lorawan
 import json
 import asyncio
+import functools
 import mqttbase
 from mqttbase import MqttBase
+from tlwpy.ingest import Ingestor
+from tlwpy.queues import OverflowPolicy, DEFAULT_MAXSIZE, create_queue, queue_stats
+
+logger = logging.getLogger('pktfwdbr')
+
+
+# these run wherever the ingestor decodes, which might be another thread or process,
+# so they only build packets and don't touch the forwarder
+def decode_rx(msg, joinreqs: bool = True, uplinks: bool = True):
+    payload_json = json.loads(msg.payload)
+    pkt_data = base64.b64decode(payload_json['data'])
+    pkt_type = lorawan.get_packet_type(pkt_data)
+    # formatting these for every packet adds up when sniffing a busy gateway
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if pkt_type == lorawan.MHDR_MTYPE_JOINREQ and joinreqs:
+        join_req = lorawan.JoinReq(pkt_data)
+        if debug:
+            logger.debug('saw joinreq for %x' % join_req.deveui)
+        return join_req
+    elif (pkt_type == lorawan.MHDR_MTYPE_CNFUP or pkt_type == lorawan.MHDR_MTYPE_UNCNFUP) and uplinks:
+        uplink = lorawan.Uplink(pkt_data)
+        if debug:
+            logger.debug(
+                'saw uplink for %x, framecounter %d, port %d' % (uplink.devaddr, uplink.framecounter, uplink.port))
+        return uplink
+    return None
+
+
+def decode_tx(msg):
+    payload_json = json.loads(msg.payload)
+    pkt_data = base64.b64decode(payload_json["txpk"]['data'])
+    pkt_type = lorawan.get_packet_type(pkt_data)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if pkt_type == lorawan.MHDR_MTYPE_JOINACK:
+        if debug:
+            logger.debug('saw joinack')
+        return lorawan.EncryptedJoinAccept(pkt_data)
+    elif pkt_type == lorawan.MHDR_MTYPE_CNFDN or pkt_type == lorawan.MHDR_MTYPE_UNCNFDN:
+        downlink = lorawan.Downlink(pkt_data)
+        if debug:
+            logger.debug('saw downlink for %x, framecounter %d, port %d' % (
+                downlink.devaddr, downlink.framecounter, downlink.port))
+        return downlink
+    if debug:
+        logger.debug('saw an unknown downlink packet')
+    return None
 
 
 class PacketForwarder(MqttBase):
-    __slots__ = ['joinacks', 'uplinks', 'downlinks', '__logger', '__mqtt_client']
+    __slots__ = ['joinreqs', 'joinacks', 'uplinks', 'downlinks', '__logger', '__mqtt_client', '__pending_joins',
+                 'downlink_router', '__ingestor', '__decode_rx']
 
     def __on_rx(self, client, userdata, msg: mqtt.MQTTMessage):
-        payload_json = json.loads(msg.payload)
-        pkt_data = base64.b64decode(payload_json['data'])
-        pkt_type = lorawan.get_packet_type(pkt_data)
-        if pkt_type == lorawan.MHDR_MTYPE_JOINREQ:
-            join_reg = lorawan.JoinReq(pkt_data)
-            self.__logger.debug('saw joinreq for %x' % join_reg.deveui)
-        elif pkt_type == lorawan.MHDR_MTYPE_CNFUP or pkt_type == lorawan.MHDR_MTYPE_UNCNFUP:
-            uplink = lorawan.Uplink(pkt_data)
-            self.__logger.debug(
-                'saw uplink for %x, framecounter %d, port %d' % (uplink.devaddr, uplink.framecounter, uplink.port))
-            self.event_loop.call_soon_threadsafe(self.uplinks.put_nowait, lorawan.Uplink(pkt_data))
+        self.__ingestor.submit(self.__decode_rx, self.__dispatch_rx, msg)
 
     def __on_tx(self, client, userdata, msg: mqtt.MQTTMessage):
-        payload_json = json.loads(msg.payload)
-        pkt_data = base64.b64decode(payload_json["txpk"]['data'])
-        pkt_type = lorawan.get_packet_type(pkt_data)
-        if pkt_type == lorawan.MHDR_MTYPE_JOINACK:
-            join_ack = lorawan.EncryptedJoinAccept(pkt_data)
-            self.__logger.debug('saw joinack')
-            self.event_loop.call_soon_threadsafe(self.joinacks.put_nowait, join_ack)
-        elif pkt_type == lorawan.MHDR_MTYPE_CNFDN or pkt_type == lorawan.MHDR_MTYPE_UNCNFDN:
-            downlink = lorawan.Downlink(pkt_data)
-            self.__logger.debug('saw downlink for %x, framecounter %d, port %d' % (
-                downlink.devaddr, downlink.framecounter, downlink.port))
-            self.event_loop.call_soon_threadsafe(self.downlinks.put_nowait, downlink)
-        else:
-            self.__logger.debug('saw an unknown downlink packet')
+        self.__ingestor.submit(decode_tx, self.__dispatch_tx, msg)
+
+    def __dispatch_rx(self, packet):
+        # the decoder only returns packets for queues that are turned on
+        if isinstance(packet, lorawan.JoinReq):
+            return self.joinreqs.offer(packet)
+        return self.uplinks.offer(packet)
+
+    def __dispatch_tx(self, packet):
+        if isinstance(packet, lorawan.EncryptedJoinAccept):
+            return self.__dispatch_joinack(packet)
+        return self.__dispatch_downlink(packet)
+
+    def __dispatch_joinack(self, join_ack: lorawan.EncryptedJoinAccept):
+        # join accepts don't carry anything that identifies the device so the
+        # only way to match them up is to try the keys of the outstanding joins.
+        # if two pending joins share a key whichever was started first gets the
+        # accept, even if it was meant for the other one, see expect_joinack()
+        for dev_eui, (key, future) in list(self.__pending_joins.items()):
+            if future.done():
+                continue
+            decrypted = join_ack.try_decrypt(key)
+            if decrypted is not None:
+                self.__logger.debug('joinack is for %s' % dev_eui)
+                future.set_result(decrypted)
+                return None
+        if self.joinacks is not None:
+            return self.joinacks.offer(join_ack)
+        return None
+
+    def __dispatch_downlink(self, downlink: lorawan.Downlink):
+        if self.downlink_router is not None and self.downlink_router(downlink):
+            return None
+        if self.downlinks is not None:
+            return self.downlinks.offer(downlink)
+        return None
+
+    def __remove_pending_join(self, dev_eui: str, future: asyncio.Future):
+        pending = self.__pending_joins.get(dev_eui)
+        if pending is not None and pending[1] is future:
+            self.__pending_joins.pop(dev_eui)
+
+    def expect_joinack(self, dev_eui: str, key: bytes):
+        assert dev_eui not in self.__pending_joins, 'join already in progress for %s' % dev_eui
+        for other_eui, (other_key, _) in self.__pending_joins.items():
+            if other_key == key:
+                self.__logger.warning('%s and %s are joining with the same key, their join accepts might get'
+                                      ' swapped and the session keys will be wrong' % (other_eui, dev_eui))
+                break
+        future = self.event_loop.create_future()
+        future.add_done_callback(lambda f: self.__remove_pending_join(dev_eui, f))
+        self.__pending_joins[dev_eui] = (key, future)
+        return future
+
+    async def wait_for_joinack(self, future: asyncio.Future, timeout: float = 10):
+        return await asyncio.wait_for(future, timeout)
 
     def __on_txack(self, client, userdata, msg: mqtt.MQTTMessage):
         self.__logger.debug('saw a txack')
 
-    def __init__(self, host: str, port: int = None):
-        rx_topic = 'pktfwdbr/+/rx/#'
-        tx_topic = 'pktfwdbr/+/tx/#'
-        txack_topic = 'pktfwdbr/+/txack/#'
-        super().__init__(host, port=port, id=mqttbase.create_client_id('pktfwdbr'),
-                         topics=[rx_topic, tx_topic, txack_topic])
-        self.joinacks = asyncio.Queue()
-        self.uplinks = asyncio.Queue()
-        self.downlinks = asyncio.Queue()
+    def queue_stats(self):
+        return queue_stats(joinreqs=self.joinreqs, joinacks=self.joinacks, uplinks=self.uplinks,
+                           downlinks=self.downlinks)
+
+    def __init__(self, host: str, port: int = None, ingestor: Ingestor = None, queue_maxsize: int = DEFAULT_MAXSIZE,
+                 queue_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, disabled_queues=(), gateway_id: str = None):
+        # without a gateway id this sees the traffic for every gateway
+        gateway = gateway_id if gateway_id is not None else '+'
+        rx_topic = 'pktfwdbr/%s/rx/#' % gateway
+        tx_topic = 'pktfwdbr/%s/tx/#' % gateway
+        txack_topic = 'pktfwdbr/%s/txack/#' % gateway
+        self.joinreqs = create_queue('joinreqs', disabled_queues, queue_maxsize, queue_policy)
+        self.joinacks = create_queue('joinacks', disabled_queues, queue_maxsize, queue_policy)
+        self.uplinks = create_queue('uplinks', disabled_queues, queue_maxsize, queue_policy)
+        self.downlinks = create_queue('downlinks', disabled_queues, queue_maxsize, queue_policy)
+        # tx still has to be looked at for joins and downlink routing but nothing needs rx
+        # if both of its queues are off so don't even subscribe to it
+        topics = [tx_topic, txack_topic]
+        if self.joinreqs is not None or self.uplinks is not None:
+            topics.append(rx_topic)
+        super().__init__(host, port=port, id=mqttbase.create_client_id('pktfwdbr'), topics=topics)
+        self.__decode_rx = functools.partial(decode_rx, joinreqs=self.joinreqs is not None,
+                                             uplinks=self.uplinks is not None)
+        self.__pending_joins = {}
+        self.downlink_router = None
         self.__logger = logging.getLogger('pktfwdbr')
+        self.__ingestor = ingestor if ingestor is not None else Ingestor(self.event_loop)
         self.mqtt_client.message_callback_add(rx_topic, self.__on_rx)
         self.mqtt_client.message_callback_add(tx_topic, self.__on_tx)
         self.mqtt_client.message_callback_add(txack_topic, self.__on_txack)
@@ -0,0 +1,55 @@
+import asyncio
+from enum import Enum
+
+DEFAULT_MAXSIZE = 1024
+
+
+class OverflowPolicy(Enum):
+    BLOCK = 0
+    DROP_OLDEST = 1
+    DROP_NEWEST = 2
+
+
+class BoundedQueue(asyncio.Queue):
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.enqueued += 1
+
+    def offer(self, item):
+        # for producers that can't block, when full the policy decides what gets dropped.
+        # with BLOCK the caller gets back an awaitable that completes once there's space
+        if self.full():
+            if self.policy == OverflowPolicy.BLOCK:
+                return self.put(item)
+            self.dropped += 1
+            if self.policy == OverflowPolicy.DROP_NEWEST:
+                return None
+            self.get_nowait()
+            self.task_done()
+        self.put_nowait(item)
+        return None
+
+    def as_dict(self):
+        return {'size': self.qsize(),
+                'maxsize': self.maxsize,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped}
+
+
+def create_queue(name: str, disabled_queues, maxsize: int = DEFAULT_MAXSIZE,
+                 policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST):
+    # consumers that don't care about a queue can turn it off, which leaves it as None
+    if name in disabled_queues:
+        return None
+    return BoundedQueue(maxsize, policy)
+
+
+def queue_stats(**queues):
+    return dict((name, queue.as_dict()) for name, queue in queues.items() if queue is not None)
@@ -0,0 +1,77 @@
+import random
+import time
+
+TMST_MASK = 0xffffffff
+
+LSNR_MIN = -20.0
+LSNR_MAX = 15.0
+
+
+class Channel:
+    __slots__ = ['freq', 'chan', 'rfch']
+
+    def __init__(self, freq: float, chan: int, rfch: int):
+        # freq is in MHz like it is in the packet forwarder's json
+        self.freq = freq
+        self.chan = chan
+        self.rfch = rfch
+
+
+class ChannelPlan:
+    __slots__ = ['name', 'channels', 'datarates']
+
+    def __init__(self, name: str, freqs: list, datarates: list):
+        self.name = name
+        # an SX1301 splits the channels across its two radios
+        self.channels = [Channel(freq, chan, 0 if chan < len(freqs) // 2 else 1) for chan, freq in enumerate(freqs)]
+        self.datarates = datarates
+
+    def pick(self):
+        return random.choice(self.channels), random.choice(self.datarates)
+
+
+_SF12_TO_SF7 = ['SF%dBW125' % sf for sf in range(12, 6, -1)]
+
+EU868 = ChannelPlan('EU868', [868.1, 868.3, 868.5, 867.1, 867.3, 867.5, 867.7, 867.9], _SF12_TO_SF7)
+# the second sub-band of the 64 channel plans is what most networks use
+US915 = ChannelPlan('US915', [round(903.9 + (0.2 * i), 1) for i in range(8)],
+                    ['SF%dBW125' % sf for sf in range(10, 6, -1)])
+AU915 = ChannelPlan('AU915', [round(916.8 + (0.2 * i), 1) for i in range(8)], _SF12_TO_SF7)
+AS923 = ChannelPlan('AS923', [923.2, 923.4, 922.2, 922.4, 922.6, 922.8, 923.0, 922.0], _SF12_TO_SF7)
+
+CHANNEL_PLANS = dict((plan.name, plan) for plan in [EU868, US915, AU915, AS923])
+
+# what the simulator always claimed before there were channel plans
+DEFAULT_CHANNEL = Channel(923.4, 1, 0)
+DEFAULT_DATARATE = 'SF10BW125'
+
+
+class Radio:
+    __slots__ = ['rssi', 'rssi_spread', 'lsnr', 'lsnr_spread', '__tmst_offset']
+
+    # the bits of rxpk that depend on the gateway that heard the frame rather than the frame
+    def __init__(self, rssi: int = -48, lsnr: float = 12.0, rssi_spread: float = 0, lsnr_spread: float = 0,
+                 tmst_offset: int = None):
+        self.rssi = rssi
+        self.rssi_spread = rssi_spread
+        self.lsnr = lsnr
+        self.lsnr_spread = lsnr_spread
+        # every concentrator's counter starts from whenever it was powered up
+        self.__tmst_offset = tmst_offset if tmst_offset is not None else random.getrandbits(32)
+
+    def tmst(self, received_at: float = None):
+        # received_at is from time.monotonic(), backhaul delays don't change when the frame was heard
+        if received_at is None:
+            received_at = time.monotonic()
+        return (int(received_at * 1000000) + self.__tmst_offset) & TMST_MASK
+
+    def sample_rssi(self):
+        if self.rssi_spread == 0:
+            return self.rssi
+        return int(round(random.gauss(self.rssi, self.rssi_spread)))
+
+    def sample_lsnr(self):
+        if self.lsnr_spread == 0:
+            return self.lsnr
+        # adding zero turns the -0.0 rounding can produce back into 0.0
+        return round(min(LSNR_MAX, max(LSNR_MIN, random.gauss(self.lsnr, self.lsnr_spread))), 1) + 0.0
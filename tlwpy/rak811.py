@@ -2,6 +2,8 @@ import logging
 import serial
 import time
 import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 
@@ -36,6 +38,119 @@ class Band(Enum):
     KR920 = 5
 
 
+RECV_STATUS_PATTERN = re.compile(r'at\+recv=([0-9]{1,3})')
+RECV_DATA_PATTERN = re.compile(r'at\+recv=0,([0-9]{1,3}),(-?[0-9]{1,3}),(-?[0-9]{1,3}),([0-9]{1,3}),([a-fA-F0-9]*)')
+OK_PATTERN = re.compile(r'OK(.*)')
+ERROR_PATTERN = re.compile(r'ERROR(.*)')
+
+LINE_TERMINATOR = b'\r\n'
+
+
+class Recv:
+    __slots__ = ['status', 'port', 'rssi', 'snr', 'payload']
+
+    def __init__(self, status: Status, port: int = None, rssi: int = None, snr: int = None, payload: bytes = None):
+        self.status = status
+        self.port = port
+        self.rssi = rssi
+        self.snr = snr
+        self.payload = payload
+
+    def __repr__(self):
+        if self.status == Status.RECV_DATA:
+            return 'Recv(%s, port %d, rssi %d, snr %d, %s)' % (self.status.name, self.port, self.rssi, self.snr,
+                                                               self.payload.hex())
+        return 'Recv(%s)' % self.status.name
+
+
+class CommandResult:
+    __slots__ = ['ok', 'value']
+
+    def __init__(self, ok: bool, value: str):
+        self.ok = ok
+        self.value = value
+
+    def __repr__(self):
+        return 'CommandResult(%s, %s)' % ('OK' if self.ok else 'ERROR', self.value)
+
+
+def parse_recv(line: str):
+    matches = RECV_STATUS_PATTERN.search(line)
+    if matches is None:
+        return None
+    try:
+        status = Status(int(matches.group(1)))
+    except ValueError:
+        status = Status.UNKNOWN
+    if status != Status.RECV_DATA:
+        return Recv(status)
+    matches = RECV_DATA_PATTERN.search(line)
+    if matches is None:
+        return None
+    data_len = int(matches.group(4))
+    data = matches.group(5)
+    if len(data) != data_len * 2:
+        raise ReceiveException('expected %d bytes of data, got %d hex digits' % (data_len, len(data)))
+    return Recv(status, int(matches.group(1)), int(matches.group(2)), int(matches.group(3)), bytes.fromhex(data))
+
+
+def parse_line(line: str):
+    # results are checked first as they're what comes back for every command
+    matches = OK_PATTERN.search(line)
+    if matches is not None:
+        return CommandResult(True, matches.group(1))
+    matches = ERROR_PATTERN.search(line)
+    if matches is not None:
+        return CommandResult(False, matches.group(1))
+    return parse_recv(line)
+
+
+class ResponseParser:
+    __slots__ = ['__buffer', '__logger', 'errors']
+
+    def __init__(self):
+        self.__buffer = bytearray()
+        self.__logger = logging.getLogger('rak811')
+        self.errors = 0
+
+    def feed(self, data: bytes):
+        # takes whatever came off the port and returns results for the lines completed by it,
+        # anything after the last terminator is held until the next feed
+        self.__buffer += data
+        results = []
+        start = 0
+        end = self.__buffer.find(LINE_TERMINATOR)
+        while end >= 0:
+            line = self.__buffer[start:end].decode('ascii', errors='replace')
+            # a garbled line is dropped on its own, it mustn't take the lines around it with it
+            try:
+                result = parse_line(line)
+            except ReceiveException as e:
+                self.__logger.warning('dropping bad line %s: %s' % (repr(line), str(e)))
+                self.errors += 1
+                result = None
+            if result is not None:
+                results.append(result)
+            start = end + len(LINE_TERMINATOR)
+            end = self.__buffer.find(LINE_TERMINATOR, start)
+        del self.__buffer[:start]
+        return results
+
+
+def encode_command(command: str, params=[]):
+    line = 'at+%s' % command
+    if len(params) > 0:
+        line += "=%s" % ','.join(params)
+    line += '\r\n'
+    return line.encode('ascii')
+
+
+def check_command_result(result: CommandResult):
+    assert isinstance(result, CommandResult)
+    if not result.ok:
+        raise CommandException(result.value)
+
+
 class Rak811:
     __slots__ = ['port', '__logger']
 
@@ -50,12 +165,9 @@ class Rak811:
         return rak811
 
     def __encode_command(self, command: str, params=[]):
-        line = 'at+%s' % command
-        if len(params) > 0:
-            line += "=%s" % ','.join(params)
+        line = encode_command(command, params)
         self.__logger.debug('sending command: %s' % line)
-        line += '\r\n'
-        return line.encode('ascii')
+        return line
 
     def __read_line(self):
         line = self.port.read_until(b'\r\n').decode('ascii')
@@ -69,12 +181,11 @@ class Rak811:
         if line is None:
             line = self.__read_line()
         self.__logger.debug('result: %s' % line)
-        matches = re.search('OK', line)
-        if matches is None:
-            matches = re.search('ERROR', line)
-            assert matches is not None
+        try:
+            check_command_result(parse_line(line))
+        except CommandException:
             self.__logger.debug('command resulted in an error')
-            raise CommandException()
+            raise
 
     def __write_line_read_result(self, out_line):
         self.port.write(out_line)
@@ -84,22 +195,12 @@ class Rak811:
         if line is None:
             line = self.__read_line()
         self.__logger.debug('recv: %s' % line)
-        matches = re.search('at\+recv=([0-9]|100)', line)
-        if matches:
-            status = Status(int(matches.group(1)))
-            if status == Status.RECV_DATA:
-                matches = re.search('at\+recv=0,([0-9]{1,3}),(-[0-9]{1,3}),([0-9]{1,3}),([0-9]{1,3}),([a-f0-9]*)', line)
-                if matches:
-                    port = int(matches.group(1))
-                    data_len = int(matches.group(4))
-                    data = matches.group(5)
-                    assert len(data) / 2 == data_len, ('expected %d bytes of data, got %d' % data_len, len(data) / 2)
-                    self.__logger.debug('have downlink on port %d' % port)
-                    return status
-            else:
-                return status
-
-        raise ReceiveException
+        recv = parse_recv(line)
+        if recv is None:
+            raise ReceiveException
+        if recv.status == Status.RECV_DATA:
+            self.__logger.debug('have downlink on port %d' % recv.port)
+        return recv
 
     def reset(self):
         self.__logger.debug('doing reset...')
@@ -163,7 +264,7 @@ class Rak811:
         self.port.write(line)
         self.__read_command_result()
 
-        status = self.__read_recv()
+        status = self.__read_recv().status
 
         valid_statuses = [Status.JOINED_SUCCESS, Status.JOINED_FAILED, Status.RX2_TIMEOUT]
         assert status in valid_statuses, 'status %s isn\'t valid here' % valid_statuses
@@ -195,5 +296,191 @@ class Rak811:
         self.__logger.debug(",".join(lines))
 
         self.__read_command_result(lines[0])
+        # returns the tx status and any downlinks that came back in the rx windows like AsyncRak811 does
+        status = None
+        downlinks = []
         for recv_line in lines[1:]:
-            self.__read_recv(recv_line)
+            recv = self.__read_recv(recv_line)
+            if recv.status == Status.RECV_DATA:
+                downlinks.append(recv)
+            else:
+                status = recv.status
+        return status, downlinks
+
+
+class AsyncRak811:
+    __slots__ = ['port', '__logger', '__reader_executor', '__reader_task', '__parser', '__results', '__events',
+                 '__command_lock', '__operation_lock', '__closing']
+
+    TX_STATUSES = [Status.TX_COMFIRMED, Status.TX_UNCOMFIRMED, Status.TX_TIMEOUT, Status.RX2_TIMEOUT,
+                   Status.DOWNLINK_REPEATED]
+    JOIN_STATUSES = [Status.JOINED_SUCCESS, Status.JOINED_FAILED, Status.RX2_TIMEOUT]
+
+    def __init__(self, port: serial.Serial):
+        self.port = port
+        self.__logger = logging.getLogger('rak811')
+        # the reader sits in a blocking read so it gets a thread of its own
+        # rather than tying up one of the loop's default executor threads per module
+        self.__reader_executor = ThreadPoolExecutor(max_workers=1)
+        self.__reader_task = None
+        self.__parser = ResponseParser()
+        self.__results = asyncio.Queue()
+        self.__events = asyncio.Queue()
+        self.__command_lock = asyncio.Lock()
+        # joins and sends span a command and the events that follow it
+        self.__operation_lock = asyncio.Lock()
+        self.__closing = False
+
+    @staticmethod
+    def from_path(path):
+        # short timeout so the reader notices when it's being shut down
+        ser = serial.Serial(path, 115200, timeout=1)
+        return AsyncRak811(ser)
+
+    def start(self):
+        if self.__reader_task is None:
+            self.__reader_task = asyncio.get_running_loop().create_task(self.__read())
+
+    async def close(self):
+        self.__closing = True
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+            try:
+                await self.__reader_task
+            except asyncio.CancelledError:
+                pass
+            self.__reader_task = None
+        self.__reader_executor.shutdown(wait=False)
+        self.port.close()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def __read_chunk(self):
+        # block for the first byte then take whatever else has arrived with it
+        chunk = self.port.read(1)
+        if len(chunk) != 0 and self.port.in_waiting > 0:
+            chunk += self.port.read(self.port.in_waiting)
+        return chunk
+
+    async def __read(self):
+        loop = asyncio.get_running_loop()
+        while not self.__closing:
+            chunk = await loop.run_in_executor(self.__reader_executor, self.__read_chunk)
+            if len(chunk) == 0:
+                continue
+            # if this task dies every command after it just times out, so a bad chunk only costs itself
+            try:
+                results = self.__parser.feed(chunk)
+            except Exception as e:
+                self.__logger.warning('failed to parse %s: %s' % (repr(chunk), repr(e)))
+                continue
+            for result in results:
+                self.__logger.debug('read: %s' % repr(result))
+                if isinstance(result, Recv):
+                    self.__events.put_nowait(result)
+                else:
+                    self.__results.put_nowait(result)
+
+    def __flush(self, queue: asyncio.Queue):
+        # anything already queued is left over from something that timed out,
+        # this is what flushInput() does for Rak811
+        while not queue.empty():
+            self.__logger.debug('discarding stale %s' % repr(queue.get_nowait()))
+
+    async def __command(self, command: str, params=[], timeout: float = 10):
+        self.start()
+        line = encode_command(command, params)
+        self.__logger.debug('sending command: %s' % line)
+        async with self.__command_lock:
+            self.__flush(self.__results)
+            await asyncio.get_running_loop().run_in_executor(None, self.port.write, line)
+            result = await asyncio.wait_for(self.__results.get(), timeout)
+            self.__logger.debug('result: %s' % result)
+            check_command_result(result)
+            return result
+
+    async def __wait_for_status(self, valid_statuses: list, timeout: float):
+        downlinks = []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            recv: Recv = await asyncio.wait_for(self.__events.get(), max(0, deadline - loop.time()))
+            if recv.status == Status.RECV_DATA:
+                self.__logger.debug('have downlink on port %d' % recv.port)
+                downlinks.append(recv)
+            elif recv.status in valid_statuses:
+                return recv.status, downlinks
+            else:
+                self.__logger.debug('ignoring unexpected status %s' % recv.status)
+
+    async def reset(self):
+        self.__logger.debug('doing reset...')
+        self.port.setDTR(1)
+        await asyncio.sleep(1)
+        self.port.setDTR(0)
+        await asyncio.sleep(1)
+        self.port.flushInput()
+
+    async def get_version(self):
+        return await self.__command('version')
+
+    async def get_band(self):
+        return await self.__command('band')
+
+    async def set_band(self, band: Band):
+        return await self.__command('band', [band.name])
+
+    async def get_class(self):
+        return await self.__command('class')
+
+    async def get_channel_list(self):
+        return await self.__command('get_config', ['ch_list'])
+
+    async def get_rx1_delay(self):
+        return await self.__command('get_config', ['rx_delay1'])
+
+    async def get_rx2(self):
+        return await self.__command('get_config', ['rx2'])
+
+    async def get_signal(self):
+        return await self.__command('signal')
+
+    async def get_frame_counters(self):
+        return await self.__command('link_cnt')
+
+    async def get_status(self):
+        return await self.__command('status')
+
+    async def set_otaa_parameters(self, app_eui: str, dev_eui: str, key: str):
+        assert app_eui is not None
+        assert dev_eui is not None
+        assert key is not None
+
+        parameters = 'app_eui:%s&dev_eui:%s&app_key:%s' % (app_eui, dev_eui, key)
+        return await self.__command('set_config', [parameters])
+
+    async def join(self, otaa=True, timeout: float = 60):
+        async with self.__operation_lock:
+            self.__flush(self.__events)
+            await self.__command('join', (['otaa'] if otaa else ['abp']))
+            status, _ = await self.__wait_for_status(self.JOIN_STATUSES, timeout)
+        joined = status == Status.JOINED_SUCCESS
+
+        # when join fails the module locks up on the next attempt so reset it
+        if not joined:
+            await self.reset()
+
+        return joined
+
+    async def send(self, port, data: bytearray, confirmed=False, timeout: float = 30):
+        assert (1 <= port <= 223)
+        async with self.__operation_lock:
+            self.__flush(self.__events)
+            await self.__command('send', [str(1 if confirmed else 0), str(port), data.hex()])
+            # returns the tx status and any downlinks that came back in the rx windows
+            return await self.__wait_for_status(self.TX_STATUSES, timeout)
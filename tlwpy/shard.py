@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from tlwpy.gatewaysimulator import Gateway, Node
+from tlwpy.loadgen import LoadGenerator, Report, INTERVAL_FIXED
+from tlwpy.metrics import Registry
+from tlwpy.tlwbe import Tlwbe
+
+# fork would copy the coordinator's event loop and mqtt threads into every worker
+DEFAULT_START_METHOD = 'spawn'
+DEFAULT_JOIN_TIMEOUT = 300
+
+
+class ShardFailed(Exception):
+    def __init__(self, index: int, error: BaseException):
+        super().__init__('shard %d failed: %s' % (index, repr(error)))
+        self.index = index
+        self.error = error
+
+
+class ShardConfig:
+    __slots__ = ['index', 'host', 'port', 'gateway_id', 'app_eui', 'credentials', 'uplink_rate', 'interval', 'fport',
+                 'payload_size', 'max_concurrent_joins']
+
+    # everything a worker needs to run its part of the network, gets pickled across to the worker
+    def __init__(self, index: int, host: str, port: int, gateway_id: str, app_eui: str, credentials: list,
+                 uplink_rate: float, interval: str = INTERVAL_FIXED, fport: int = 1, payload_size: int = 8,
+                 max_concurrent_joins: int = 32):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.gateway_id = gateway_id
+        self.app_eui = app_eui
+        # [(dev_eui, key)]
+        self.credentials = credentials
+        self.uplink_rate = uplink_rate
+        self.interval = interval
+        self.fport = fport
+        self.payload_size = payload_size
+        self.max_concurrent_joins = max_concurrent_joins
+
+
+def generate_credentials(count: int, eui_base: int = None):
+    eui_base = eui_base if eui_base is not None else random.getrandbits(32) << 24
+    return [('%016x' % ((eui_base + i) & 0xffffffffffffffff), os.urandom(16).hex()) for i in range(count)]
+
+
+def partition(credentials: list, shards: int):
+    # round robin so every shard gets a mix of the euis, empty shards are left out
+    assert shards > 0
+    return [part for part in [credentials[i::shards] for i in range(shards)] if len(part) > 0]
+
+
+async def provision(tlwbe: Tlwbe, app_eui: str, credentials: list, name_prefix: str = 'shard',
+                    max_in_flight: int = 32):
+    # returns the credentials that were added, anything that failed is left out of the run
+    devs = [('%s_%s' % (name_prefix, dev_eui), app_eui, dev_eui, key) for dev_eui, key in credentials]
+    result = await tlwbe.add_devs(devs, max_in_flight=max_in_flight)
+    failed = set([index for index, _, _ in result.failures])
+    return [credential for index, credential in enumerate(credentials) if index not in failed]
+
+
+async def deprovision(tlwbe: Tlwbe, credentials: list, max_in_flight: int = 32):
+    return await tlwbe.delete_devs([dev_eui for dev_eui, _ in credentials], max_in_flight=max_in_flight)
+
+
+async def _drive_shard(config: ShardConfig, barrier, duration: float, join_timeout: float):
+    logger = logging.getLogger('shard')
+    gateway = Gateway(config.host, config.port, gateway_id=config.gateway_id)
+    # provisioning was done by the coordinator so the load generator never needs tlwbe
+    loadgen = LoadGenerator(gateway, None, config.app_eui, len(config.credentials), config.uplink_rate,
+                            interval=config.interval, port=config.fport, payload_size=config.payload_size,
+                            max_concurrent_joins=config.max_concurrent_joins)
+    loadgen.nodes = [Node(gateway, config.app_eui, dev_eui, key) for dev_eui, key in config.credentials]
+    joined = await loadgen.join()
+    logger.info('shard %d joined %d of %d nodes' % (config.index, len(joined), len(config.credentials)))
+    # joins take however long they take, the uplink phase should overlap across all of the shards
+    if barrier is not None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, barrier.wait, join_timeout)
+        except threading.BrokenBarrierError:
+            logger.warning('shard %d gave up waiting for the other shards to join' % config.index)
+    report = await loadgen.drive(joined, duration)
+    return report, gateway.metrics
+
+
+def run_shard(config: ShardConfig, barrier=None, duration: float = 60, join_timeout: float = DEFAULT_JOIN_TIMEOUT):
+    # entry point in the worker process, every shard has its own loop and mqtt connection
+    try:
+        return asyncio.run(_drive_shard(config, barrier, duration, join_timeout))
+    except BaseException:
+        # don't leave the other shards waiting on one that isn't coming
+        if barrier is not None:
+            barrier.abort()
+        raise
+
+
+class Coordinator:
+    __slots__ = ['__host', '__port', '__app_eui', '__credentials', '__uplink_rate', '__shards', '__gateway_id',
+                 '__shard_kwargs', '__start_method', '__join_timeout', '__logger', 'report', 'metrics',
+                 'shard_reports', 'failures']
+
+    def __init__(self, host: str, port: int, app_eui: str, credentials: list, uplink_rate: float,
+                 shards: int = None, gateway_id: str = 'shardgw', start_method: str = DEFAULT_START_METHOD,
+                 join_timeout: float = DEFAULT_JOIN_TIMEOUT, **shard_kwargs):
+        # shard_kwargs are passed on to ShardConfig, i.e. interval, fport, payload_size
+        assert len(app_eui) == 16
+        assert len(credentials) > 0
+        assert uplink_rate > 0
+        self.__host = host
+        self.__port = port
+        self.__app_eui = app_eui
+        self.__credentials = credentials
+        self.__uplink_rate = uplink_rate
+        self.__shards = shards if shards is not None else os.cpu_count()
+        self.__gateway_id = gateway_id
+        self.__shard_kwargs = shard_kwargs
+        self.__start_method = start_method
+        self.__join_timeout = join_timeout
+        self.__logger = logging.getLogger('shard')
+        self.report = None
+        self.metrics = None
+        self.shard_reports = {}
+        # shard index -> ShardFailed
+        self.failures = {}
+
+    def configs(self):
+        parts = partition(self.__credentials, self.__shards)
+        # each shard's share of the rate follows its share of the nodes
+        return [ShardConfig(index, self.__host, self.__port, '%s%d' % (self.__gateway_id, index), self.__app_eui,
+                            part, self.__uplink_rate * len(part) / len(self.__credentials), **self.__shard_kwargs)
+                for index, part in enumerate(parts)]
+
+    async def run(self, duration: float):
+        configs = self.configs()
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context(self.__start_method)
+        self.__logger.info('running %d nodes across %d shards' % (len(self.__credentials), len(configs)))
+        # a manager's barrier can be passed to pool workers, a plain one can only be inherited
+        with context.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=len(configs), mp_context=context) as executor:
+            barrier = manager.Barrier(len(configs))
+            results = await asyncio.gather(*[loop.run_in_executor(executor, run_shard, config, barrier, duration,
+                                                                   self.__join_timeout)
+                                             for config in configs], return_exceptions=True)
+
+        self.report = Report(0)
+        self.metrics = Registry()
+        self.shard_reports = {}
+        self.failures = {}
+        for config, result in zip(configs, results):
+            if isinstance(result, BaseException):
+                self.__logger.warning('shard %d failed: %s' % (config.index, repr(result)))
+                self.failures[config.index] = ShardFailed(config.index, result)
+                continue
+            report, metrics = result
+            self.shard_reports[config.index] = report
+            self.report.merge(report)
+            self.metrics.merge(metrics)
+        return self.report
+
+    def as_dict(self):
+        return {'report': self.report.as_dict() if self.report is not None else None,
+                'shards': dict((index, report.as_dict()) for index, report in self.shard_reports.items()),
+                'failures': dict((index, repr(failure.error)) for index, failure in self.failures.items()),
+                'metrics': self.metrics.as_dict() if self.metrics is not None else None}
@@ -1,7 +1,6 @@
 import paho.mqtt.client as mqtt
 from uuid import uuid4
 import json
-from asyncio import Queue
 from asyncio import Future
 import asyncio
 import base64
@@ -9,6 +8,10 @@ import logging
 import mqttbase
 from mqttbase import MqttBase
 from datetime import datetime
+from tlwpy.ingest import Ingestor
+from tlwpy.metrics import Registry
+from tlwpy.tracer import DownlinkTracer
+from tlwpy.queues import OverflowPolicy, DEFAULT_MAXSIZE, create_queue, queue_stats
 
 ACTION_ADD = 'add'
 ACTION_GET = 'get'
@@ -38,6 +41,27 @@ TOPIC_UPLINK_RESULT = 'tlwbe/uplinks/result/#'
 
 RESULT_OK = 0
 
+DEFAULT_TIMEOUT = 10
+
+DEFAULT_MAX_IN_FLIGHT = 64
+
+DEFAULT_PAGE_SIZE = 100
+
+
+def request_operation(topic: str):
+    # the metrics label for a request topic, control topics are tlwbe/control/<what>/<action>
+    # and everything else is tlwbe/<what>/<action> followed by whatever identifies the target
+    parts = topic.split('/')
+    if parts[1] == 'control':
+        return '/'.join(parts[1:4])
+    return '/'.join(parts[1:3])
+
+
+class QueryException(Exception):
+    def __init__(self, result):
+        super().__init__('query failed with code %d' % result.code)
+        self.result = result
+
 
 class Join:
     __slots__ = 'appeui', 'deveui', 'timestamp'
@@ -70,6 +94,10 @@ class App:
         self.eui = json_app['eui']
 
 
+def decode_uplink(msg):
+    return Uplink(json.loads(msg.payload))
+
+
 class Dev:
     __slots__ = ['name', 'eui', 'app_eui', 'key', 'serial']
 
@@ -82,24 +110,135 @@ class Dev:
 
 
 class Result:
-    __slots__ = ['token', 'result', 'code',
-                 'eui_list', 'app', 'dev', 'uplinks']
+    __slots__ = ['token', '__payload', '__result', '__uplinks']
 
     def __init__(self, msg: mqtt.MQTTMessage):
+        # only the topic is looked at here, this gets created on the network thread and
+        # results can be big so decoding is left until something asks for it
         self.token = msg.topic.split("/")[-1]
-        self.result = json.loads(msg.payload.decode('utf-8'))
-        self.code = self.result['code']
+        self.__payload = msg.payload
+        self.__result = None
+        self.__uplinks = None
+
+    def decode(self):
+        if self.__result is None:
+            self.__result = json.loads(self.__payload.decode('utf-8'))
+            self.__payload = None
+        return self.__result
+
+    @property
+    def result(self):
+        return self.decode()
+
+    @property
+    def code(self):
+        return self.decode()['code']
+
+    @property
+    def eui_list(self):
+        return self.decode().get('eui_list')
+
+    @property
+    def app(self):
+        app = self.decode().get('app')
+        return App(app) if app is not None else None
+
+    @property
+    def dev(self):
+        dev = self.decode().get('dev')
+        return Dev(dev) if dev is not None else None
+
+    def iter_uplinks(self):
+        for ul in self.decode().get('uplinks', []):
+            yield Uplink(ul)
+
+    def iter_downlinks(self):
+        for dl in self.decode().get('downlinks', []):
+            yield dl
+
+    @property
+    def uplinks(self):
+        if self.__uplinks is None and 'uplinks' in self.decode():
+            self.__uplinks = list(self.iter_uplinks())
+        return self.__uplinks
+
+
+class RequestTracker:
+    __slots__ = ['__pending', 'completed', 'timeouts', 'cancelled', 'late_results']
+
+    def __init__(self):
+        self.__pending = {}
+        self.completed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.late_results = 0
+
+    @property
+    def in_flight(self):
+        return len(self.__pending)
+
+    def track(self, token: str, future: Future):
+        self.__pending[token] = future
+
+    def discard(self, token: str):
+        self.__pending.pop(token, None)
+
+    def resolve(self, token: str, result):
+        future = self.__pending.pop(token, None)
+        # anything that isn't pending anymore has already been given up on by the caller
+        if future is None or future.done():
+            self.late_results += 1
+            return False
+        future.set_result(result)
+        return True
+
+    async def wait(self, token: str, future: Future, timeout: float):
+        try:
+            result = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            # however the wait ended the token mustn't outlive it
+            self.__pending.pop(token, None)
+        self.completed += 1
+        return result
 
-        if 'eui_list' in self.result:
-            self.eui_list = self.result['eui_list']
-        elif 'app' in self.result:
-            self.app = App(self.result['app'])
-        elif 'dev' in self.result:
-            self.dev = Dev(self.result['dev'])
-        elif 'uplinks' in self.result:
-            self.uplinks = []
-            for ul in self.result['uplinks']:
-                self.uplinks.append(Uplink(ul))
+    def as_dict(self):
+        return {'in_flight': self.in_flight,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'cancelled': self.cancelled,
+                'late_results': self.late_results}
+
+
+class BulkResult:
+    __slots__ = ['items', 'results', 'failures', 'callback_errors']
+
+    def __init__(self, items: list, results: list, callback_errors: int = 0):
+        self.items = items
+        # results line up with items, anything that failed outright is the exception instead of a Result
+        self.results = results
+        self.failures = []
+        self.callback_errors = callback_errors
+        for index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                failed = True
+            else:
+                try:
+                    failed = result.code != RESULT_OK
+                except (KeyError, TypeError, ValueError):
+                    # a reply that doesn't have a code can't be counted as a success
+                    failed = True
+            if failed:
+                self.failures.append((index, items[index], result))
+
+    @property
+    def ok(self):
+        return len(self.failures) == 0
 
 
 class Tlwbe(MqttBase):
@@ -107,180 +246,328 @@ class Tlwbe(MqttBase):
                  'queue_uplinks',
                  '__id',
                  '__logger',
-                 '__control_results',
-                 '__uplink_results',
-                 '__downlink_results']
+                 'requests',
+                 'timeout',
+                 '__ingestor',
+                 '__result_ingestor',
+                 'downlink_tracer',
+                 'metrics']
 
     def __dump_message(self, msg):
         self.__logger.debug('publish on %s' % msg.topic)
 
     def __on_join(self, client, userdata, msg):
         self.__dump_message(msg)
-        self.event_loop.call_soon_threadsafe(self.queue_joins.put_nowait, Join(msg))
+        if self.queue_joins is not None:
+            self.__ingestor.submit(Join, self.queue_joins.offer, msg)
 
     def __on_uplink(self, client, userdata, msg):
         self.__dump_message(msg)
-        uplink_json = json.loads(msg.payload)
-        self.event_loop.call_soon_threadsafe(self.queue_uplinks.put_nowait, Uplink(uplink_json))
+        if self.queue_uplinks is not None:
+            self.__ingestor.submit(decode_uplink, self.queue_uplinks.offer, msg)
 
-    def __on_result(self, msg, results: dict):
-        self.__dump_message(msg)
-        result = Result(msg)
+    def __resolve_result(self, result):
         self.__logger.debug('have result for %s' % result.token)
-        if result.token.startswith(self.__id):
-            if result.token in results:
-                future: Future = results.pop(result.token)
-                self.event_loop.call_soon_threadsafe(future.set_result, result)
-            else:
-                self.__logger.warning('rogue result')
-        else:
+        if not result.token.startswith(self.__id):
             self.__logger.debug('ignoring result, probably not for us')
+        elif not self.requests.resolve(result.token, result):
+            self.__logger.debug('late result for %s' % result.token)
 
-    def __on_control_result(self, client, userdata, msg):
-        self.__on_result(msg, self.__control_results)
-
-    def __on_uplink_result(self, client, userdata, msg):
-        self.__on_result(msg, self.__uplink_results)
+    def __on_result(self, client, userdata, msg):
+        self.__dump_message(msg)
+        # results get an ingestor of their own that never drops anything, a request whose result got
+        # pushed out by a burst of uplinks would just time out. the tracker is still only touched from the loop
+        self.__result_ingestor.submit(Result, self.__resolve_result, msg)
 
-    def __on_downlink_result(self, client, userdata, msg):
-        self.__on_result(msg, self.__downlink_results)
+    def queue_stats(self):
+        return queue_stats(queue_joins=self.queue_joins, queue_uplinks=self.queue_uplinks)
 
-    def __init__(self, host: str = 'localhost', port: int = None):
+    def __init__(self, host: str = 'localhost', port: int = None, timeout: float = DEFAULT_TIMEOUT,
+                 ingestor: Ingestor = None, queue_maxsize: int = DEFAULT_MAXSIZE,
+                 queue_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, disabled_queues=(),
+                 metrics: Registry = None, downlink_tracer: DownlinkTracer = None):
         self.__id = mqttbase.create_client_id('tlwbe')
         super().__init__(host, port=port, id=self.__id,
                          topics=[TOPIC_CONTROL_RESULT, TOPIC_UPLINK_RESULT, TOPIC_DOWNLINK_RESULT])
-        self.queue_joins = Queue()
-        self.queue_uplinks = Queue()
-        self.__control_results = {}
-        self.__uplink_results = {}
-        self.__downlink_results = {}
+        self.queue_joins = create_queue('queue_joins', disabled_queues, queue_maxsize, queue_policy)
+        self.queue_uplinks = create_queue('queue_uplinks', disabled_queues, queue_maxsize, queue_policy)
+        self.requests = RequestTracker()
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Registry()
+        # shared with whatever captures the downlinks on the gateway side, i.e. gatewaysimulator.Gateway
+        self.downlink_tracer = downlink_tracer
+        self.__ingestor = ingestor if ingestor is not None else Ingestor(self.event_loop)
+        # Result only looks at the topic until something asks for more so there's nothing to offload
+        self.__result_ingestor = Ingestor(self.event_loop, max_pending=0)
 
         self.mqtt_client.message_callback_add('tlwbe/join/+/+', self.__on_join)
         self.mqtt_client.message_callback_add('tlwbe/uplink/#', self.__on_uplink)
-        self.mqtt_client.message_callback_add(TOPIC_CONTROL_RESULT, self.__on_control_result)
-        self.mqtt_client.message_callback_add(TOPIC_UPLINK_RESULT, self.__on_uplink_result)
-        self.mqtt_client.message_callback_add(TOPIC_DOWNLINK_RESULT, self.__on_downlink_result)
+        self.mqtt_client.message_callback_add(TOPIC_CONTROL_RESULT, self.__on_result)
+        self.mqtt_client.message_callback_add(TOPIC_UPLINK_RESULT, self.__on_result)
+        self.mqtt_client.message_callback_add(TOPIC_DOWNLINK_RESULT, self.__on_result)
 
         self.__logger = logging.getLogger('tlwbe')
 
-    async def __publish_and_wait_for_result(self, topic: str, payload: dict, results: dict):
-        token = "%s_%s" % (self.__id, str(uuid4()))
-        future = asyncio.get_running_loop().create_future()
-        results[token] = future
-        await self.wait_for_connection()
-        msginfo = self.mqtt_client.publish("%s/%s" % (topic, token), json.dumps(payload))
-        assert msginfo.rc == mqtt.MQTT_ERR_SUCCESS, 'rc was %d' % msginfo.rc
-        result = await asyncio.wait_for(future, 10)
+    async def __publish_and_wait_for_result(self, topic: str, payload: dict, timeout: float = None):
+        if timeout is None:
+            timeout = self.timeout
+        operation = request_operation(topic)
+        in_flight = self.metrics.gauge('tlwbe_requests_in_flight', operation=operation)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        outcome = 'error'
+        in_flight.inc()
+        try:
+            token = "%s_%s" % (self.__id, str(uuid4()))
+            future = loop.create_future()
+            self.requests.track(token, future)
+            try:
+                await self.wait_for_connection()
+                msginfo = self.mqtt_client.publish("%s/%s" % (topic, token), json.dumps(payload))
+                assert msginfo.rc == mqtt.MQTT_ERR_SUCCESS, 'rc was %d' % msginfo.rc
+            except BaseException:
+                self.requests.discard(token)
+                raise
+            result = await self.requests.wait(token, future, timeout)
+            outcome = 'ok'
+            self.metrics.histogram('tlwbe_request_seconds', operation=operation).observe(loop.time() - start)
+            return result
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            in_flight.dec()
+            self.metrics.counter('tlwbe_requests_total', operation=operation, outcome=outcome).inc()
+
+    async def __publish_and_wait_for_control_result(self, topic: str, payload: dict, timeout: float = None):
+        return await self.__publish_and_wait_for_result(topic, payload, timeout)
+
+    async def __publish_and_wait_for_query_result(self, topic: str, payload: dict, timeout: float = None):
+        result = await self.__publish_and_wait_for_result(topic, payload, timeout)
+        # query results can be huge so decode them without holding up the loop
+        await asyncio.get_running_loop().run_in_executor(None, result.decode)
         return result
 
-    async def __publish_and_wait_for_control_result(self, topic: str, payload: dict):
-        return await self.__publish_and_wait_for_result(topic, payload, self.__control_results)
+    async def __publish_and_wait_for_uplink_result(self, topic: str, payload: dict, timeout: float = None):
+        return await self.__publish_and_wait_for_query_result(topic, payload, timeout)
 
-    async def __publish_and_wait_for_uplink_result(self, topic: str, payload: dict):
-        return await self.__publish_and_wait_for_result(topic, payload, self.__uplink_results)
-
-    async def __publish_and_wait_for_downlink_result(self, topic: str, payload: dict):
-        return await self.__publish_and_wait_for_result(topic, payload, self.__downlink_results)
+    async def __publish_and_wait_for_downlink_result(self, topic: str, payload: dict, timeout: float = None):
+        return await self.__publish_and_wait_for_result(topic, payload, timeout)
 
     def __sub_to_topic(self, topic: str):
         self.__logger.debug('subscribing to %s' % topic)
         self.mqtt_client.subscribe(topic)
 
-    async def add_dev(self, name: str, app_eui: str, eui: str = None, key: str = None):
+    async def add_dev(self, name: str, app_eui: str, eui: str = None, key: str = None, timeout: float = None):
         assert name is not None and app_eui is not None
         payload = {'name': name, 'appeui': app_eui}
         if eui is not None:
             payload['eui'] = eui
         if key is not None:
             payload['key'] = key
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_ADD, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_ADD, payload, timeout)
         return result
 
-    async def get_dev_by_name(self, name: str):
+    async def get_dev_by_name(self, name: str, timeout: float = None):
         payload = {'name': name}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_GET, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_GET, payload, timeout)
         return result
 
-    async def get_dev_by_eui(self, eui: str):
+    async def get_dev_by_eui(self, eui: str, timeout: float = None):
         payload = {'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_GET, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_GET, payload, timeout)
         return result
 
-    async def update_dev(self, name: str, eui: str):
+    async def update_dev(self, name: str, eui: str, timeout: float = None):
         payload = {'name': name, 'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_UPDATE, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_UPDATE, payload, timeout)
         return result
 
-    async def delete_dev(self, eui: str):
+    async def delete_dev(self, eui: str, timeout: float = None):
         payload = {'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_DELETE, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_DELETE, payload, timeout)
         return result
 
-    async def list_devs(self):
+    async def list_devs(self, timeout: float = None):
         payload = {}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_LIST, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_DEV_LIST, payload, timeout)
         return result
 
-    async def add_app(self, name: str, eui: str = None):
+    async def add_app(self, name: str, eui: str = None, timeout: float = None):
         payload = {'name': name}
         if eui is not None:
             payload['eui'] = eui
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_ADD, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_ADD, payload, timeout)
         return result
 
-    async def get_app_by_name(self, name: str):
+    async def get_app_by_name(self, name: str, timeout: float = None):
         payload = {'name': name}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_GET, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_GET, payload, timeout)
         return result
 
-    async def get_app_by_eui(self, eui: str):
+    async def get_app_by_eui(self, eui: str, timeout: float = None):
         payload = {'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_GET, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_GET, payload, timeout)
         return result
 
-    async def update_app(self, name: str, eui: str):
+    async def update_app(self, name: str, eui: str, timeout: float = None):
         payload = {'name': name, 'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_UPDATE, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_UPDATE, payload, timeout)
         return result
 
-    async def delete_app(self, eui: str):
+    async def delete_app(self, eui: str, timeout: float = None):
         payload = {'eui': eui}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_DELETE, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_DELETE, payload, timeout)
         return result
 
-    async def list_apps(self):
+    async def list_apps(self, timeout: float = None):
         payload = {}
-        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_LIST, payload)
+        result = await self.__publish_and_wait_for_control_result(TOPIC_APP_LIST, payload, timeout)
         return result
 
-    async def list_uplinks(self, app_eui: str, dev_eui: str):
+    @staticmethod
+    def __create_query(app_eui: str, dev_eui: str, limit: int, offset: int, since):
         payload = {}
         if app_eui is not None:
             payload['appeui'] = app_eui
         if dev_eui is not None:
             payload['deveui'] = dev_eui
-        result = await self.__publish_and_wait_for_uplink_result(TOPIC_UPLINK_QUERY, payload)
+        if limit is not None:
+            payload['limit'] = limit
+        if offset is not None:
+            payload['offset'] = offset
+        if since is not None:
+            # timestamps on the tlwbe side are in microseconds
+            if isinstance(since, datetime):
+                since = int(since.timestamp() * 1000000)
+            payload['since'] = since
+        return payload
+
+    async def list_uplinks(self, app_eui: str, dev_eui: str, limit: int = None, offset: int = None, since=None,
+                           timeout: float = None):
+        payload = self.__create_query(app_eui, dev_eui, limit, offset, since)
+        result = await self.__publish_and_wait_for_uplink_result(TOPIC_UPLINK_QUERY, payload, timeout)
         return result
 
-    async def list_downlinks(self, app_eui: str = None, dev_eui: str = None):
-        payload = {}
-        if app_eui is not None:
-            payload['appeui'] = app_eui
-        if dev_eui is not None:
-            payload['deveui'] = dev_eui
-
-        result = await self.__publish_and_wait_for_downlink_result(TOPIC_DOWNLINK_QUERY, payload)
+    async def list_downlinks(self, app_eui: str = None, dev_eui: str = None, limit: int = None, offset: int = None,
+                             since=None, timeout: float = None):
+        payload = self.__create_query(app_eui, dev_eui, limit, offset, since)
+        result = await self.__publish_and_wait_for_query_result(TOPIC_DOWNLINK_QUERY, payload, timeout)
         return result
 
+    async def __iter_pages(self, query, key: str, page_size: int):
+        offset = 0
+        loop = asyncio.get_running_loop()
+        next_page = loop.create_task(query(page_size, offset))
+        try:
+            while next_page is not None:
+                result = await next_page
+                if result.code != RESULT_OK:
+                    raise QueryException(result)
+                count = len(result.result.get(key, []))
+                offset += count
+                # start fetching the next page while the caller works through this one
+                next_page = loop.create_task(query(page_size, offset)) if count == page_size else None
+                yield result
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_uplinks(self, app_eui: str = None, dev_eui: str = None, since=None,
+                           page_size: int = DEFAULT_PAGE_SIZE, timeout: float = None):
+        async def query(limit, offset):
+            return await self.list_uplinks(app_eui, dev_eui, limit=limit, offset=offset, since=since, timeout=timeout)
+
+        pages = self.__iter_pages(query, 'uplinks', page_size)
+        try:
+            async for result in pages:
+                for uplink in result.iter_uplinks():
+                    yield uplink
+        finally:
+            # if the caller stopped early this is what cancels the prefetch, not whenever pages gets collected
+            await pages.aclose()
+
+    async def iter_downlinks(self, app_eui: str = None, dev_eui: str = None, since=None,
+                             page_size: int = DEFAULT_PAGE_SIZE, timeout: float = None):
+        async def query(limit, offset):
+            return await self.list_downlinks(app_eui, dev_eui, limit=limit, offset=offset, since=since,
+                                             timeout=timeout)
+
+        pages = self.__iter_pages(query, 'downlinks', page_size)
+        try:
+            async for result in pages:
+                for downlink in result.iter_downlinks():
+                    yield downlink
+        finally:
+            await pages.aclose()
+
+    async def __bulk(self, request, items: list, max_in_flight: int, on_result=None):
+        items = list(items)
+        semaphore = asyncio.Semaphore(max_in_flight)
+        callback_errors = 0
+
+        async def run(item):
+            nonlocal callback_errors
+            async with semaphore:
+                try:
+                    result = await request(item)
+                except Exception as e:
+                    self.__logger.warning('bulk request failed: %s' % repr(e))
+                    result = e
+            if on_result is not None:
+                # a broken callback mustn't cost the caller every other result
+                try:
+                    on_result(item, result)
+                except Exception as e:
+                    self.__logger.warning('bulk result callback failed: %s' % repr(e))
+                    callback_errors += 1
+            return result
+
+        results = await asyncio.gather(*[run(item) for item in items])
+        return BulkResult(items, results, callback_errors)
+
+    async def add_devs(self, devs, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        # devs is an iterable of (name, app_eui, eui, key) like add_dev() takes
+        return await self.__bulk(lambda dev: self.add_dev(*dev), devs, max_in_flight, on_result)
+
+    async def get_devs(self, euis, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        return await self.__bulk(self.get_dev_by_eui, euis, max_in_flight, on_result)
+
+    async def update_devs(self, devs, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        # devs is an iterable of (name, eui)
+        return await self.__bulk(lambda dev: self.update_dev(*dev), devs, max_in_flight, on_result)
+
+    async def delete_devs(self, euis, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        return await self.__bulk(self.delete_dev, euis, max_in_flight, on_result)
+
+    async def add_apps(self, apps, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        # apps is an iterable of (name, eui)
+        return await self.__bulk(lambda app: self.add_app(*app), apps, max_in_flight, on_result)
+
+    async def get_apps(self, euis, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        return await self.__bulk(self.get_app_by_eui, euis, max_in_flight, on_result)
+
+    async def delete_apps(self, euis, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, on_result=None):
+        return await self.__bulk(self.delete_app, euis, max_in_flight, on_result)
+
     def listen_for_joins(self, appeui: str, deveui: str):
         self.__sub_to_topic('tlwbe/join/%s/%s' % (appeui, deveui))
 
     def listen_for_uplinks(self, appeui: str, deveui: str, port: int):
         self.__sub_to_topic('tlwbe/uplink/%s/%s/%d' % (appeui, deveui, port))
 
-    async def send_downlink(self, app_eui: str, dev_eui: str, port: int, payload: bytes = None, confirm=False):
+    def listen_for_all_uplinks(self):
+        self.__sub_to_topic('tlwbe/uplink/#')
+
+    async def send_downlink(self, app_eui: str, dev_eui: str, port: int, payload: bytes = None, confirm=False,
+                            timeout: float = None):
         msg_topic = 'tlwbe/downlink/schedule/%s/%s/%d' % (app_eui, dev_eui, port)
         msg_payload = {'confirm': confirm}
         if payload is not None:
             msg_payload['payload'] = base64.b64encode(payload).decode('ascii')
-        return await self.__publish_and_wait_for_downlink_result(msg_topic, msg_payload)
+        if self.downlink_tracer is not None:
+            self.downlink_tracer.track(dev_eui, port, payload)
+        return await self.__publish_and_wait_for_downlink_result(msg_topic, msg_payload, timeout)
@@ -0,0 +1,130 @@
+import collections
+import logging
+import time
+from tlwpy.metrics import Registry
+
+DEFAULT_TIMEOUT = 30
+
+
+class FrameTracer:
+    __slots__ = ['__pending', '__order', '__timeout', '__histogram', '__lost_format', 'logger', 'metrics', 'sent',
+                 'matched', 'lost', 'unexpected']
+
+    # matches frames sent by one component up with where they come out of another,
+    # frames are matched up by (dev_eui, port, payload) -> [(sent at, details for logging)]
+    def __init__(self, histogram: str, lost_format: str, logger: str, timeout: float = DEFAULT_TIMEOUT,
+                 metrics: Registry = None):
+        self.__pending = {}
+        # everything in the order it was sent so expiry doesn't have to look at every device
+        self.__order = collections.deque()
+        self.__timeout = timeout
+        self.__histogram = histogram
+        self.__lost_format = lost_format
+        self.logger = logging.getLogger(logger)
+        self.metrics = metrics if metrics is not None else Registry()
+        self.sent = 0
+        self.matched = 0
+        self.lost = 0
+        self.unexpected = 0
+
+    @staticmethod
+    def key(dev_eui: str, port: int, payload: bytes):
+        return dev_eui.lower(), port, bytes(payload) if payload is not None else b''
+
+    @property
+    def in_flight(self):
+        return sum([len(sent) for sent in self.__pending.values()])
+
+    def track_key(self, key: tuple, details: tuple):
+        sent = self.__pending.get(key)
+        if sent is None:
+            sent = collections.deque()
+            self.__pending[key] = sent
+        entry = (time.monotonic(), details)
+        sent.append(entry)
+        self.__order.append((key, entry))
+        self.sent += 1
+
+    def expire(self):
+        # anything that hasn't turned up in time is counted as lost
+        deadline = time.monotonic() - self.__timeout
+        while len(self.__order) > 0 and self.__order[0][1][0] < deadline:
+            key, entry = self.__order.popleft()
+            sent = self.__pending.get(key)
+            # matching takes the oldest for a key so if this one isn't at the front it already arrived
+            if sent is None or sent[0] is not entry:
+                continue
+            sent.popleft()
+            if len(sent) == 0:
+                self.__pending.pop(key)
+            self.logger.debug(self.__lost_format % entry[1])
+            self.lost += 1
+
+    def match_key(self, key: tuple):
+        # returns the latency if it matched something that was sent
+        now = time.monotonic()
+        self.expire()
+        sent = self.__pending.get(key)
+        if sent is None:
+            self.unexpected += 1
+            return None
+        sent_at, _ = sent.popleft()
+        if len(sent) == 0:
+            self.__pending.pop(key)
+        latency = now - sent_at
+        self.matched += 1
+        self.metrics.histogram(self.__histogram).observe(latency)
+        return latency
+
+    @property
+    def loss_rate(self):
+        finished = self.matched + self.lost
+        if finished == 0:
+            return 0.0
+        return self.lost / finished
+
+    def as_dict(self):
+        self.expire()
+        return {'sent': self.sent,
+                'matched': self.matched,
+                'lost': self.lost,
+                'unexpected': self.unexpected,
+                'in_flight': self.in_flight,
+                'loss_rate': self.loss_rate,
+                'latency': self.metrics.histogram(self.__histogram).as_dict()}
+
+
+class UplinkTracer(FrameTracer):
+    __slots__ = []
+
+    # gateway simulator -> tlwbe. tlwbe's uplinks don't carry the devaddr or frame counter
+    # so those are only kept for logging what got lost
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, metrics: Registry = None):
+        super().__init__('uplink_latency_seconds', 'lost uplink from %x, framecounter %d', 'tracer', timeout, metrics)
+
+    def track(self, dev_eui: str, port: int, payload: bytes, dev_addr: int, framecounter: int):
+        self.track_key(self.key(dev_eui, port, payload), (dev_addr, framecounter))
+
+    def received(self, uplink):
+        # uplink is a tlwbe.Uplink
+        return self.match_key(self.key(uplink.dev_eui, uplink.port, uplink.payload))
+
+    async def consume(self, queue):
+        # for feeding from Tlwbe.queue_uplinks when nothing else needs the uplinks
+        while True:
+            self.received(await queue.get())
+
+
+class DownlinkTracer(FrameTracer):
+    __slots__ = []
+
+    # Tlwbe.send_downlink -> the downlink turning up on pktfwdbr's tx topic. the frame on the
+    # gateway side is encrypted so whoever captures it has to have the session keys to decrypt it
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, metrics: Registry = None):
+        super().__init__('downlink_latency_seconds', 'lost downlink for %s, port %d', 'tracer', timeout, metrics)
+
+    def track(self, dev_eui: str, port: int, payload: bytes):
+        self.track_key(self.key(dev_eui, port, payload), (dev_eui, port))
+
+    def captured(self, dev_eui: str, port: int, payload: bytes):
+        return self.match_key(self.key(dev_eui, port, payload))